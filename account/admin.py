@@ -4,6 +4,7 @@ from account.models import (
     Account,
     AccountDeletion,
     EmailAddress,
+    EmailOutbox,
     PasswordExpiry,
     PasswordHistory,
     SignupCode,
@@ -40,6 +41,13 @@ class EmailAddressAdmin(AccountAdmin):
         return super().get_queryset(request).select_related('user')
 
 
+class EmailOutboxAdmin(admin.ModelAdmin):
+
+    list_display = ["subject", "created", "sent", "attempts", "next_attempt"]
+    list_filter = ["sent"]
+    search_fields = ["subject"]
+
+
 class PasswordExpiryAdmin(admin.ModelAdmin):
 
     raw_id_fields = ["user"]
@@ -60,5 +68,6 @@ admin.site.register(Account, AccountAdmin)
 admin.site.register(SignupCode, SignupCodeAdmin)
 admin.site.register(AccountDeletion, AccountDeletionAdmin)
 admin.site.register(EmailAddress, EmailAddressAdmin)
+admin.site.register(EmailOutbox, EmailOutboxAdmin)
 admin.site.register(PasswordExpiry, PasswordExpiryAdmin)
 admin.site.register(PasswordHistory, PasswordHistoryAdmin)
@@ -1,9 +1,13 @@
+import functools
+
 from django.contrib.auth import get_user_model
 from django.contrib.auth.backends import ModelBackend
-from django.db.models import Q
+from django.db.models import OuterRef, Q, Subquery
 
-from account.models import EmailAddress
-from account.utils import get_user_lookup_kwargs
+from account.cache import user_cache
+from account.conf import settings
+from account.models import EmailAddress, PasswordHistory
+from account.utils import iexact
 
 User = get_user_model()
 
@@ -11,16 +15,32 @@ User = get_user_model()
 class AccountModelBackend(ModelBackend):
     """
     This authentication backend ensures that the account is always selected
-    on any query with the user, so we don't issue extra unnecessary queries
+    on any query with the user, so we don't issue extra unnecessary queries.
+    When password history is used the password expiry and the latest
+    password timestamp are loaded in the same query.
     """
 
     def get_user(self, user_id):
         """Get the user and select account at the same time"""
-        user = User._default_manager.filter(pk=user_id).select_related("account").first()
+        if settings.ACCOUNT_USER_CACHE:
+            user = user_cache.get(user_id, functools.partial(self.load_user, user_id))
+        else:
+            user = self.load_user(user_id)
         if not user:
             return None
         return user if self.user_can_authenticate(user) else None
 
+    @staticmethod
+    def load_user(user_id):
+        qs = User._default_manager.filter(pk=user_id).select_related("account")
+        if settings.ACCOUNT_PASSWORD_USE_HISTORY:
+            # preload what check_password_expired needs
+            latest = PasswordHistory.objects.filter(user=OuterRef("pk")).order_by("-timestamp")
+            qs = qs.select_related("password_expiry").annotate(
+                latest_password_timestamp=Subquery(latest.values("timestamp")[:1])
+            )
+        return qs.first()
+
 
 class UsernameAuthenticationBackend(AccountModelBackend):
     """Username authentication"""
@@ -31,10 +51,7 @@ class UsernameAuthenticationBackend(AccountModelBackend):
             return None
 
         try:
-            lookup_kwargs = get_user_lookup_kwargs({
-                "{username}__iexact": username
-            })
-            user = User.objects.get(**lookup_kwargs)
+            user = iexact(User.objects.all(), User.USERNAME_FIELD, username).get()
         except User.DoesNotExist:
             return None
 
@@ -53,7 +70,7 @@ class EmailAuthenticationBackend(AccountModelBackend):
             return None
 
         try:
-            email_address = qs.get(email__iexact=username)
+            email_address = iexact(qs, "email", username).get()
         except EmailAddress.DoesNotExist:
             return None
 
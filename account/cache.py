@@ -0,0 +1,257 @@
+import contextlib
+import threading
+import time
+from collections import OrderedDict
+
+from django.contrib.auth import get_user_model
+from django.core.cache import caches
+from django.db import router, transaction
+
+from account.conf import settings
+
+
+def get_version(key):
+    """
+    Returns the version counter stored under key in the user cache.
+    """
+    backend = caches[settings.ACCOUNT_USER_CACHE_ALIAS]
+    version = backend.get(key)
+    if version is None:
+        # start from the clock so a counter that was evicted from the
+        # cache never repeats a version that was handed out before
+        version = time.time_ns()
+        if not backend.add(key, version, None):
+            version = backend.get(key, version)
+    return version
+
+
+def peek_version(key):
+    """
+    Returns the version counter stored under key, or None if there is none,
+    without creating it.
+    """
+    return caches[settings.ACCOUNT_USER_CACHE_ALIAS].get(key)
+
+
+def bump_version(key):
+    backend = caches[settings.ACCOUNT_USER_CACHE_ALIAS]
+    try:
+        backend.incr(key)
+    except ValueError:
+        backend.set(key, time.time_ns(), None)
+
+
+def bump_versions(keys):
+    """
+    Bumps the version counters among keys that exist, with one get_many and
+    one set_many. The counters expire after ACCOUNT_USER_CACHE_TIMEOUT
+    seconds.
+    """
+    backend = caches[settings.ACCOUNT_USER_CACHE_ALIAS]
+    versions = backend.get_many(keys)
+    if versions:
+        backend.set_many(
+            {key: version + 1 for key, version in versions.items()},
+            settings.ACCOUNT_USER_CACHE_TIMEOUT,
+        )
+
+
+def password_expiry_version_key(user_id):
+    return "account:password_expiry:{0}:version".format(user_id)
+
+
+_deferred = threading.local()
+
+
+def password_expiry_deferred():
+    """
+    Returns whether password expiry invalidations are being collected by
+    defer_password_expiry_invalidation.
+    """
+    return getattr(_deferred, "user_ids", None) is not None
+
+
+@contextlib.contextmanager
+def defer_password_expiry_invalidation():
+    """
+    Collects the password expiry invalidations made inside the block and
+    invalidates each user once when it exits.
+    """
+    if password_expiry_deferred():
+        yield
+        return
+    _deferred.user_ids = set()
+    try:
+        yield
+    finally:
+        user_ids, _deferred.user_ids = _deferred.user_ids, None
+        for user_id in user_ids:
+            invalidate_password_expiry(user_id)
+
+
+def invalidate_password_expiry(user_id):
+    """
+    Forces sessions of the given user to recompute their password expiry.
+    """
+    if password_expiry_deferred():
+        _deferred.user_ids.add(user_id)
+        return
+    key = password_expiry_version_key(user_id)
+    bump_version(key)
+    transaction.on_commit(lambda: bump_version(key))
+
+
+def invalidate_password_expiry_many(user_ids):
+    """
+    Like invalidate_password_expiry for many users, for bulk changes. Only
+    existing counters are bumped; sessions of users without one recompute
+    their password expiry within ACCOUNT_USER_CACHE_TIMEOUT seconds anyway.
+    """
+    keys = [password_expiry_version_key(user_id) for user_id in user_ids]
+    bump_versions(keys)
+    if transaction.get_connection().in_atomic_block:
+        transaction.on_commit(lambda: bump_versions(keys))
+
+
+class UserCache:
+    """
+    Caches a compact snapshot of a user (and their account) keyed by user id.
+
+    Snapshots live in a bounded per-process LRU in front of the configured
+    Django cache. Every snapshot is stamped with a per-user version counter
+    held in the Django cache; bumping the counter invalidates the snapshot on
+    every process that shares the cache. Snapshots also expire
+    ``ACCOUNT_USER_CACHE_TIMEOUT`` seconds after they were loaded, in both
+    tiers, so changes that bypass the signals are eventually picked up.
+    """
+
+    def __init__(self):
+        self._local = OrderedDict()
+        self._lock = threading.Lock()
+        self.reset_stats()
+
+    @property
+    def backend(self):
+        return caches[settings.ACCOUNT_USER_CACHE_ALIAS]
+
+    @staticmethod
+    def version_key(user_id):
+        return "account:user:{0}:version".format(user_id)
+
+    @staticmethod
+    def snapshot_key(user_id, version):
+        return "account:user:{0}:{1}".format(user_id, version)
+
+    def get_version(self, user_id):
+        return get_version(self.version_key(user_id))
+
+    def get(self, user_id, load):
+        """
+        Returns the user with the given id, calling ``load`` on a miss.
+        """
+        # the version must be read before loading so a concurrent
+        # invalidation can never be masked by a stale snapshot.
+        version = self.get_version(user_id)
+        with self._lock:
+            entry = self._local.get(user_id)
+            if entry is not None and entry[0] == version and not self.expired(entry[1]):
+                self._local.move_to_end(user_id)
+                self.hits += 1
+                return self.restore(entry[1])
+        snapshot = self.backend.get(self.snapshot_key(user_id, version))
+        if snapshot is not None and not self.expired(snapshot):
+            self.shared_hits += 1
+        else:
+            self.misses += 1
+            user = load()
+            if user is None:
+                return None
+            snapshot = self.snapshot(user)
+            timeout = settings.ACCOUNT_USER_CACHE_TIMEOUT
+            snapshot["expires"] = time.time() + timeout if timeout is not None else None
+            self.backend.set(self.snapshot_key(user_id, version), snapshot, timeout)
+        self.remember(user_id, version, snapshot)
+        return self.restore(snapshot)
+
+    @staticmethod
+    def expired(snapshot):
+        return snapshot["expires"] is not None and snapshot["expires"] <= time.time()
+
+    def remember(self, user_id, version, snapshot):
+        with self._lock:
+            self._local[user_id] = (version, snapshot)
+            self._local.move_to_end(user_id)
+            while len(self._local) > settings.ACCOUNT_USER_CACHE_SIZE:
+                self._local.popitem(last=False)
+
+    def invalidate(self, user_id):
+        """
+        Bumps the version for the given user. The bump is repeated once the
+        current transaction commits so readers cannot cache rows that were
+        not yet visible to them.
+        """
+        self._invalidate(user_id)
+        transaction.on_commit(lambda: self._invalidate(user_id))
+
+    def _invalidate(self, user_id):
+        with self._lock:
+            self._local.pop(user_id, None)
+        bump_version(self.version_key(user_id))
+
+    def clear(self):
+        with self._lock:
+            self._local.clear()
+
+    def reset_stats(self):
+        self.hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "shared_hits": self.shared_hits,
+            "misses": self.misses,
+            "size": len(self._local),
+        }
+
+    @staticmethod
+    def snapshot(user):
+        from account.models import Account
+
+        snapshot = {
+            "user": {f.attname: getattr(user, f.attname) for f in user._meta.concrete_fields},
+            "account": None,
+        }
+        try:
+            account = user.account
+        except Account.DoesNotExist:
+            pass
+        else:
+            snapshot["account"] = {f.attname: getattr(account, f.attname) for f in account._meta.concrete_fields}
+        return snapshot
+
+    @staticmethod
+    def restore(snapshot):
+        from account.models import Account
+
+        User = get_user_model()
+        user = User.from_db(
+            router.db_for_read(User),
+            list(snapshot["user"].keys()),
+            list(snapshot["user"].values()),
+        )
+        account = None
+        if snapshot["account"] is not None:
+            account = Account.from_db(
+                router.db_for_read(Account),
+                list(snapshot["account"].keys()),
+                list(snapshot["account"].values()),
+            )
+            account.user = user
+        # mirrors select_related("account"): a missing account is cached too
+        User.account.related.set_cached_value(user, account)
+        return user
+
+
+user_cache = UserCache()
@@ -35,6 +35,10 @@ class AccountAppConf(AppConf):
     PASSWORD_RESET_TOKEN_URL = "account_password_reset_token"
     PASSWORD_EXPIRY = 0
     PASSWORD_USE_HISTORY = False
+    PASSWORD_HISTORY_KEEP = None
+    PASSWORD_HISTORY_KEEP_DAYS = None
+    PASSWORD_EXPIRY_EXEMPT_URL_NAMES = []
+    PASSWORD_EXPIRY_EXEMPT_PATHS = []
     ACCOUNT_APPROVAL_REQUIRED = False
     PASSWORD_STRIP = True
     REMEMBER_ME_EXPIRY = 60 * 60 * 24 * 365 * 10
@@ -44,6 +48,9 @@ class AccountAppConf(AppConf):
     EMAIL_CONFIRMATION_REQUIRED = False
     EMAIL_CONFIRMATION_EMAIL = True
     EMAIL_CONFIRMATION_EXPIRE_DAYS = 3
+    EMAIL_CONFIRMATION_SIGNED = False
+    EMAIL_CONFIRMATION_REUSE = False
+    EMAIL_CONFIRMATION_RESEND_INTERVAL = 0
     EMAIL_CONFIRMATION_AUTO_LOGIN = False
     EMAIL_CONFIRMATION_ANONYMOUS_REDIRECT_URL = "account_login"
     EMAIL_CONFIRMATION_AUTHENTICATED_REDIRECT_URL = None
@@ -51,7 +58,22 @@ class AccountAppConf(AppConf):
     SETTINGS_REDIRECT_URL = "account_settings"
     NOTIFY_ON_PASSWORD_CHANGE = True
     DELETION_EXPUNGE_HOURS = 48
+    DELETION_EXPUNGE_LEASE = 60 * 5
+    DELETION_EXPUNGE_RELATED_BATCH_SIZE = None
+    DELETION_EXPUNGE_SLEEP = 0
+    DELETION_EXPUNGE_RELATED_MODELS = []
     DEFAULT_HTTP_PROTOCOL = "https"
+    USER_CACHE = False
+    USER_CACHE_ALIAS = "default"
+    USER_CACHE_TIMEOUT = 60 * 5
+    USER_CACHE_SIZE = 1000
+    EMAIL_OUTBOX_MAX_ATTEMPTS = 5
+    EMAIL_OUTBOX_RETRY_DELAY = 60
+    EMAIL_OUTBOX_LEASE = 60 * 5
+    EMAIL_DISPATCH_WORKERS = 2
+    EMAIL_DISPATCH_QUEUE_SIZE = 1000
+    EMAIL_DISPATCH_BLOCK_TIMEOUT = 0
+    EMAIL_DISPATCH_IDLE_TIMEOUT = 30
     HOOKSET = "account.hooks.AccountDefaultHookSet"
     TIMEZONES = TIMEZONES
     LANGUAGES = LANGUAGES
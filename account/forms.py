@@ -10,7 +10,7 @@ from django.utils.translation import gettext_lazy as _
 from account.conf import settings
 from account.hooks import hookset
 from account.models import EmailAddress
-from account.utils import get_user_lookup_kwargs
+from account.utils import iexact
 
 alnum_re = re.compile(r"^[\w\-\.\+]+$")
 
@@ -65,17 +65,14 @@ class SignupForm(forms.Form):
             raise forms.ValidationError(
                 _("Usernames can only contain letters, numbers and the following special characters ./+/-/_")
             )
-        lookup_kwargs = get_user_lookup_kwargs({
-            "{username}__iexact": self.cleaned_data["username"]
-        })
-        qs = User.objects.filter(**lookup_kwargs)
+        qs = iexact(User.objects.all(), User.USERNAME_FIELD, self.cleaned_data["username"])
         if not qs.exists():
             return self.cleaned_data["username"]
         raise forms.ValidationError(_("This username is already taken. Please choose another."))
 
     def clean_email(self):
         value = self.cleaned_data["email"]
-        qs = EmailAddress.objects.filter(email__iexact=value)
+        qs = iexact(EmailAddress.objects.all(), "email", value)
         if not qs.exists() or not settings.ACCOUNT_EMAIL_UNIQUE:
             return value
         raise forms.ValidationError(_("A user is registered with this email address."))
@@ -187,7 +184,7 @@ class PasswordResetForm(forms.Form):
 
     def clean_email(self):
         value = self.cleaned_data["email"]
-        if not EmailAddress.objects.filter(email__iexact=value).exists():
+        if not iexact(EmailAddress.objects.all(), "email", value).exists():
             raise forms.ValidationError(_("Email address can not be found."))
         return value
 
@@ -230,7 +227,7 @@ class SettingsForm(forms.Form):
         value = self.cleaned_data["email"]
         if self.initial.get("email") == value:
             return value
-        qs = EmailAddress.objects.filter(email__iexact=value)
+        qs = iexact(EmailAddress.objects.all(), "email", value)
         if not qs.exists() or not settings.ACCOUNT_EMAIL_UNIQUE:
             return value
         raise forms.ValidationError(_("A user is registered with this email address."))
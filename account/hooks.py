@@ -1,42 +1,64 @@
 import hashlib
 import random
+import time
 
 from django import forms
-from django.core.mail import send_mail
-from django.template.loader import render_to_string
+from django.apps import apps
+from django.contrib.auth import get_user_model
+from django.core.mail import EmailMessage, get_connection, send_mail
+from django.db import transaction
 from django.utils.translation import gettext_lazy as _
 
 from account.conf import settings
+from account.mail import EmailDispatcher, renderer
 
 
 class AccountDefaultHookSet:
 
-    @staticmethod
-    def send_invitation_email(to, ctx):
-        subject = render_to_string("account/email/invite_user_subject.txt", ctx)
-        message = render_to_string("account/email/invite_user.txt", ctx)
-        send_mail(subject, message, settings.DEFAULT_FROM_EMAIL, to)
+    def send_invitation_email(self, to, ctx):
+        self.send_email(*renderer.render("invite_user", ctx), to)
 
-    @staticmethod
-    def send_confirmation_email(to, ctx):
-        subject = render_to_string("account/email/email_confirmation_subject.txt", ctx)
-        subject = "".join(subject.splitlines())  # remove superfluous line breaks
-        message = render_to_string("account/email/email_confirmation_message.txt", ctx)
-        send_mail(subject, message, settings.DEFAULT_FROM_EMAIL, to)
+    def send_invitation_emails(self, invitations):
+        """
+        Sends an iterable of ``(to, ctx, language)`` invitations at once.
+        """
+        self.send_emails(
+            (subject, message, to) for to, subject, message in renderer.render_many("invite_user", invitations)
+        )
+
+    def send_confirmation_email(self, to, ctx):
+        self.send_email(*renderer.render("email_confirmation", ctx), to)
+
+    def send_password_change_email(self, to, ctx):
+        self.send_email(*renderer.render("password_change", ctx), to)
+
+    def send_password_reset_email(self, to, ctx):
+        self.send_email(*renderer.render("password_reset", ctx), to)
+
+    def send_password_expiry_warning_emails(self, warnings):
+        """
+        Sends an iterable of ``(to, ctx, language)`` password expiry warnings
+        at once.
+        """
+        self.send_emails(
+            (subject, message, to)
+            for to, subject, message in renderer.render_many("password_expiry_warning", warnings)
+        )
 
     @staticmethod
-    def send_password_change_email(to, ctx):
-        subject = render_to_string("account/email/password_change_subject.txt", ctx)
-        subject = "".join(subject.splitlines())
-        message = render_to_string("account/email/password_change.txt", ctx)
-        send_mail(subject, message, settings.DEFAULT_FROM_EMAIL, to)
+    def send_email(subject, message, to):
+        # mail is only sent once the surrounding transaction commits so locks
+        # are not held across the SMTP round trip and rolled back work never
+        # sends mail; outside a transaction it is sent right away
+        transaction.on_commit(lambda: send_mail(subject, message, settings.DEFAULT_FROM_EMAIL, to))
 
     @staticmethod
-    def send_password_reset_email(to, ctx):
-        subject = render_to_string("account/email/password_reset_subject.txt", ctx)
-        subject = "".join(subject.splitlines())
-        message = render_to_string("account/email/password_reset.txt", ctx)
-        send_mail(subject, message, settings.DEFAULT_FROM_EMAIL, to)
+    def send_emails(emails):
+        """
+        Sends an iterable of ``(subject, message, to)`` over one connection.
+        """
+        messages = [EmailMessage(subject, message, settings.DEFAULT_FROM_EMAIL, to) for subject, message, to in emails]
+        transaction.on_commit(lambda: get_connection().send_messages(messages))
 
     @staticmethod
     def generate_random_token(extra=None, hash_func=hashlib.sha256):
@@ -72,10 +94,100 @@ class AccountDefaultHookSet:
         deletion.user.is_active = False
         deletion.user.save()
 
-    @staticmethod
-    def account_delete_expunge(deletion):
+    def account_delete_expunge(self, deletion):
+        if settings.ACCOUNT_DELETION_EXPUNGE_RELATED_BATCH_SIZE:
+            self.account_delete_related(deletion.user)
         deletion.user.delete()
 
+    def account_delete_expunge_many(self, deletions):
+        if type(self).account_delete_expunge is not AccountDefaultHookSet.account_delete_expunge:
+            # hooksets that only customise the per-account hook keep getting
+            # called for every deletion
+            for deletion in deletions:
+                self.account_delete_expunge(deletion)
+            return
+        # related rows were already purged by AccountDeletion.expunge_many
+        User = get_user_model()
+        User._default_manager.filter(pk__in=[deletion.user_id for deletion in deletions]).delete()
+
+    @staticmethod
+    def account_delete_related(user):
+        """
+        Deletes rows referencing user in batches of
+        ACCOUNT_DELETION_EXPUNGE_RELATED_BATCH_SIZE, each in a short transaction, so
+        the final user delete does not have to collect them all at once.
+        """
+        from account.cache import defer_password_expiry_invalidation
+
+        User = get_user_model()
+        querysets = [
+            apps.get_model("account", "EmailConfirmation").objects.filter(email_address__user=user),
+            apps.get_model("account", "EmailAddress").objects.filter(user=user),
+            apps.get_model("account", "PasswordHistory").objects.filter(user=user),
+            apps.get_model("account", "SignupCodeResult").objects.filter(user=user),
+        ]
+        for label in settings.ACCOUNT_DELETION_EXPUNGE_RELATED_MODELS:
+            model = apps.get_model(label)
+            for field in model._meta.concrete_fields:
+                if field.is_relation and field.related_model == User:
+                    querysets.append(model._base_manager.filter(**{field.name: user}))
+        batch_size = settings.ACCOUNT_DELETION_EXPUNGE_RELATED_BATCH_SIZE
+        with defer_password_expiry_invalidation():
+            for queryset in querysets:
+                while True:
+                    with transaction.atomic():
+                        pks = list(queryset.values_list("pk", flat=True)[:batch_size])
+                        if pks:
+                            queryset.model._base_manager.filter(pk__in=pks).delete()
+                    if len(pks) < batch_size:
+                        break
+                    if settings.ACCOUNT_DELETION_EXPUNGE_SLEEP:
+                        time.sleep(settings.ACCOUNT_DELETION_EXPUNGE_SLEEP)
+
+
+class AccountOutboxHookSet(AccountDefaultHookSet):
+    """
+    Stores rendered emails in the EmailOutbox table instead of sending them.
+    Rows are written in the current transaction and delivered later by the
+    deliver_account_emails command.
+    """
+
+    @staticmethod
+    def send_email(subject, message, to):
+        EmailOutbox = apps.get_model("account", "EmailOutbox")
+        EmailOutbox.objects.create(
+            subject=subject,
+            message=message,
+            from_email=settings.DEFAULT_FROM_EMAIL,
+            to=list(to),
+        )
+
+    @staticmethod
+    def send_emails(emails):
+        EmailOutbox = apps.get_model("account", "EmailOutbox")
+        EmailOutbox.objects.bulk_create([
+            EmailOutbox(subject=subject, message=message, from_email=settings.DEFAULT_FROM_EMAIL, to=list(to))
+            for subject, message, to in emails
+        ])
+
+
+class AccountThreadedHookSet(AccountDefaultHookSet):
+    """
+    Hands emails to an in-process EmailDispatcher once the current
+    transaction commits, so requests return as soon as the email is rendered.
+    """
+
+    def __init__(self):
+        self.dispatcher = EmailDispatcher()
+
+    def send_email(self, subject, message, to):
+        email = EmailMessage(subject, message, settings.DEFAULT_FROM_EMAIL, to)
+        transaction.on_commit(lambda: self.dispatcher.submit(email))
+
+    def send_emails(self, emails):
+        messages = [EmailMessage(subject, message, settings.DEFAULT_FROM_EMAIL, to) for subject, message, to in emails]
+        transaction.on_commit(lambda: [self.dispatcher.submit(message) for message in messages])
+
 
 class HookProxy:
 
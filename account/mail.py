@@ -0,0 +1,237 @@
+import atexit
+import contextlib
+import logging
+import os
+import queue
+import threading
+
+from django.core.mail import get_connection
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.template.loader import get_template
+from django.utils import translation
+from django.utils.autoreload import file_changed
+
+from account.conf import settings
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+_DEFAULT = object()
+
+EMAIL_TEMPLATES = {
+    "invite_user": ("account/email/invite_user_subject.txt", "account/email/invite_user.txt"),
+    "email_confirmation": (
+        "account/email/email_confirmation_subject.txt",
+        "account/email/email_confirmation_message.txt",
+    ),
+    "password_change": ("account/email/password_change_subject.txt", "account/email/password_change.txt"),
+    "password_reset": ("account/email/password_reset_subject.txt", "account/email/password_reset.txt"),
+    "password_expiry_warning": (
+        "account/email/password_expiry_warning_subject.txt",
+        "account/email/password_expiry_warning.txt",
+    ),
+}
+
+
+class EmailRenderer:
+    """
+    Renders account emails from compiled templates that are loaded once per
+    process instead of being resolved through the template loaders on every
+    send.
+    """
+
+    def __init__(self):
+        self._templates = {}
+        self._lock = threading.Lock()
+
+    def get_template(self, name):
+        template = self._templates.get(name)
+        if template is None:
+            template = get_template(name)
+            with self._lock:
+                self._templates[name] = template
+        return template
+
+    def clear(self):
+        with self._lock:
+            self._templates.clear()
+
+    def render(self, kind, ctx):
+        """
+        Returns the subject and message of the email kind (a key of
+        EMAIL_TEMPLATES) rendered with ctx.
+        """
+        subject_template, message_template = EMAIL_TEMPLATES[kind]
+        subject = self.get_template(subject_template).render(ctx)
+        subject = "".join(subject.splitlines())  # remove superfluous line breaks
+        message = self.get_template(message_template).render(ctx)
+        return subject, message
+
+    def render_many(self, kind, emails):
+        """
+        Renders an iterable of ``(to, ctx, language)`` tuples and yields
+        ``(to, subject, message)``. Emails are grouped by language so each
+        language is activated once; a language of None keeps the current one.
+        """
+        groups = {}
+        for to, ctx, language in emails:
+            groups.setdefault(language, []).append((to, ctx))
+        for language, group in groups.items():
+            with translation.override(language, deactivate=False) if language else contextlib.nullcontext():
+                for to, ctx in group:
+                    yield (to,) + self.render(kind, ctx)
+
+
+renderer = EmailRenderer()
+
+
+@receiver(setting_changed)
+def clear_email_templates(setting, **kwargs):
+    if setting == "TEMPLATES":
+        renderer.clear()
+
+
+@receiver(file_changed)
+def clear_changed_email_templates(sender, file_path, **kwargs):
+    # runserver reloads edited templates without restarting the process
+    if file_path.suffix != ".py":
+        renderer.clear()
+
+
+class EmailDispatcher:
+    """
+    Delivers email messages from a bounded in-process queue on a small pool
+    of worker threads.
+
+    Each worker keeps its own mail connection open while there is work and
+    closes it after ``ACCOUNT_EMAIL_DISPATCH_IDLE_TIMEOUT`` seconds without a
+    message. When the queue is full ``submit`` waits up to
+    ``ACCOUNT_EMAIL_DISPATCH_BLOCK_TIMEOUT`` seconds for space before the
+    message is dropped and counted. Pending messages are flushed when the
+    process exits.
+    """
+
+    def __init__(self, workers=None, queue_size=None, block_timeout=_DEFAULT, idle_timeout=None):
+        self.workers = workers or settings.ACCOUNT_EMAIL_DISPATCH_WORKERS
+        self.queue_size = queue_size or settings.ACCOUNT_EMAIL_DISPATCH_QUEUE_SIZE
+        # None blocks until there is space in the queue
+        if block_timeout is _DEFAULT:
+            block_timeout = settings.ACCOUNT_EMAIL_DISPATCH_BLOCK_TIMEOUT
+        self.block_timeout = block_timeout
+        self.idle_timeout = idle_timeout or settings.ACCOUNT_EMAIL_DISPATCH_IDLE_TIMEOUT
+        self._lock = threading.Lock()
+        self._queue = None
+        self._threads = []
+        self._pid = None
+        self._registered = False
+        self.reset_stats()
+
+    def start(self):
+        with self._lock:
+            # threads do not survive a fork, so a forked child starts its own
+            if self._pid == os.getpid():
+                return
+            if not self._registered:
+                atexit.register(self.shutdown)
+                self._registered = True
+            self._pid = os.getpid()
+            self._queue = queue.Queue(self.queue_size)
+            self._threads = [
+                threading.Thread(target=self.work, name="account-email-{0}".format(i), daemon=True)
+                for i in range(self.workers)
+            ]
+            for thread in self._threads:
+                thread.start()
+
+    def submit(self, message):
+        """
+        Queues message for delivery and returns whether it was accepted.
+        """
+        self.start()
+        try:
+            if self.block_timeout == 0:
+                self._queue.put_nowait(message)
+            else:
+                self._queue.put(message, timeout=self.block_timeout)
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+            logger.warning("Email queue is full, dropped message to %s", ", ".join(message.to))
+            return False
+        return True
+
+    def work(self):
+        connection = None
+        while True:
+            try:
+                message = self._queue.get(timeout=self.idle_timeout)
+            except queue.Empty:
+                if connection is not None:
+                    connection.close()
+                    connection = None
+                continue
+            try:
+                if message is _STOP:
+                    break
+                connection = self.send(connection, message)
+            finally:
+                self._queue.task_done()
+        if connection is not None:
+            connection.close()
+
+    def send(self, connection, message):
+        """
+        Sends message, opening a connection if there is none, and returns the
+        connection to use for the next message.
+        """
+        try:
+            if connection is None:
+                connection = get_connection()
+                connection.open()
+            connection.send_messages([message])
+        except Exception:
+            logger.exception("Failed to send email to %s", ", ".join(message.to))
+            with self._lock:
+                self.failed += 1
+            # the connection may be unusable; the next message reopens it
+            if connection is not None:
+                connection.close()
+            return None
+        with self._lock:
+            self.sent += 1
+        return connection
+
+    def flush(self):
+        """
+        Blocks until every queued message has been handled.
+        """
+        if self._pid == os.getpid():
+            self._queue.join()
+
+    def shutdown(self, timeout=None):
+        """
+        Delivers pending messages and stops the workers.
+        """
+        with self._lock:
+            if self._pid != os.getpid():
+                return
+            self._pid = None
+        for thread in self._threads:
+            self._queue.put(_STOP)
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    def reset_stats(self):
+        self.sent = 0
+        self.failed = 0
+        self.dropped = 0
+
+    def stats(self):
+        return {
+            "sent": self.sent,
+            "failed": self.failed,
+            "dropped": self.dropped,
+            "queued": self._queue.qsize() if self._queue is not None else 0,
+        }
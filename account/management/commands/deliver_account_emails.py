@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+
+from account.models import EmailOutbox
+
+
+class Command(BaseCommand):
+
+    help = "Deliver emails queued in the account email outbox."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "-b", "--batch-size",
+            type=int,
+            default=100,
+            help="number of emails claimed and sent per batch"
+        )
+
+    def handle(self, *args, **options):
+        def progress(count):
+            self.stdout.write("{0} emails sent so far".format(count))
+
+        count = EmailOutbox.deliver(batch_size=options["batch_size"], callback=progress)
+        return "{0} emails sent.".format(count)
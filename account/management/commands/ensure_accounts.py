@@ -0,0 +1,49 @@
+from django.core.management.base import BaseCommand
+
+from account.models import Account
+
+
+class Command(BaseCommand):
+
+    help = "Create missing accounts and primary email addresses for existing users."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "-b", "--batch-size",
+            type=int,
+            default=1000,
+            help="number of users checked per batch"
+        )
+        parser.add_argument(
+            "--start-pk",
+            type=int,
+            default=None,
+            help="only check users with a pk greater than this, e.g. to resume an interrupted run"
+        )
+        parser.add_argument(
+            "--end-pk",
+            type=int,
+            default=None,
+            help="only check users with a pk up to and including this"
+        )
+        parser.add_argument(
+            "--no-emails",
+            action="store_false",
+            dest="emails",
+            help="do not create missing primary email addresses"
+        )
+
+    def handle(self, *args, **options):
+        def progress(last_pk, accounts, emails):
+            self.stdout.write("checked users up to pk {0}: {1} accounts, {2} email addresses created".format(
+                last_pk, accounts, emails
+            ))
+
+        accounts, emails = Account.objects.ensure_accounts(
+            start_pk=options["start_pk"],
+            end_pk=options["end_pk"],
+            batch_size=options["batch_size"],
+            emails=options["emails"],
+            callback=progress,
+        )
+        return "{0} accounts and {1} email addresses created.".format(accounts, emails)
@@ -1,12 +1,63 @@
+import multiprocessing
+import time
+
 from django.core.management.base import BaseCommand
+from django.db import connections
 
 from account.models import AccountDeletion
 
 
+def expunge_worker(batch_size):
+    try:
+        return AccountDeletion.expunge(batch_size=batch_size, worker=True)
+    finally:
+        connections.close_all()
+
+
 class Command(BaseCommand):
 
     help = "Expunge accounts deleted more than 48 hours ago."
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "-b", "--batch-size",
+            type=int,
+            default=None,
+            help="expunge accounts in batches of this size"
+        )
+        parser.add_argument(
+            "--worker",
+            action="store_true",
+            help="claim batches so several expunge_deleted commands can run at once"
+        )
+        parser.add_argument(
+            "-w", "--workers",
+            type=int,
+            default=1,
+            help="number of worker processes to fork (implies --worker)"
+        )
+
     def handle(self, *args, **options):
-        count = AccountDeletion.expunge()
-        print("{0} expunged.".format(count))
+        start = time.monotonic()
+
+        def progress(count):
+            elapsed = time.monotonic() - start
+            self.stdout.write("{0} expunged ({1:.1f} accounts/s)".format(count, count / elapsed if elapsed else 0))
+
+        if options["workers"] > 1:
+            count = self.run_workers(options["workers"], options["batch_size"])
+            progress(count)
+        else:
+            count = AccountDeletion.expunge(
+                batch_size=options["batch_size"],
+                callback=progress,
+                worker=options["worker"],
+            )
+        self.stdout.write("{0} expunged.".format(count))
+
+    @staticmethod
+    def run_workers(workers, batch_size):
+        # connections must not be shared with the forked processes
+        connections.close_all()
+        with multiprocessing.get_context("fork").Pool(workers) as pool:
+            return sum(pool.map(expunge_worker, [batch_size] * workers))
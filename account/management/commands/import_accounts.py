@@ -0,0 +1,117 @@
+import itertools
+import time
+
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand, CommandError
+from django.db import IntegrityError, models
+
+from account.models import Account
+from account.utils import open_records
+
+
+class Command(BaseCommand):
+
+    help = "Create users with accounts and primary email addresses from a CSV or JSON lines file."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "path",
+            help="CSV file with a header row or JSON lines file of objects; - reads stdin"
+        )
+        parser.add_argument(
+            "--format",
+            choices=["csv", "jsonl"],
+            help="input format, guessed from the file extension by default"
+        )
+        parser.add_argument(
+            "-b", "--batch-size",
+            type=int,
+            default=1000,
+            help="number of users created per transaction"
+        )
+        parser.add_argument(
+            "--skip",
+            type=int,
+            default=0,
+            help="number of rows to skip, e.g. to resume an import that stopped"
+        )
+        parser.add_argument(
+            "--password-history",
+            action="store_true",
+            help="record each imported password in the password history"
+        )
+        parser.add_argument(
+            "--verified",
+            action="store_true",
+            help="mark imported email addresses as verified"
+        )
+
+    def handle(self, *args, **options):
+        skip = options["skip"]
+        start = time.monotonic()
+        committed = 0
+
+        def progress(count):
+            nonlocal committed
+            committed = count
+            elapsed = time.monotonic() - start
+            self.stdout.write("{0} imported ({1:.1f} rows/s)".format(count, count / elapsed if elapsed else 0))
+
+        with open_records(options["path"], options["format"]) as records:
+            try:
+                count = Account.objects.bulk_provision(
+                    (self.build_user(record) for record in itertools.islice(records, skip, None)),
+                    batch_size=options["batch_size"],
+                    password_history=options["password_history"],
+                    verified=options["verified"],
+                    callback=progress,
+                )
+            except IntegrityError as e:
+                # earlier batches are committed; the failing one was rolled back
+                raise CommandError(
+                    "{0}\n{1} rows were imported before the batch that failed. "
+                    "Fix the input and rerun with --skip={2} to resume.".format(e, committed, skip + committed)
+                )
+        return "{0} users imported.".format(count)
+
+    @classmethod
+    def build_user(cls, record):
+        """
+        Builds an unsaved user from a record. ``password_hash`` is stored as
+        is, ``password`` is hashed and users with neither get an unusable
+        password. Other keys must be user fields; boolean fields accept
+        values such as ``true``, ``false``, ``1`` and ``0``.
+        """
+        User = get_user_model()
+        record = dict(record)
+        password_hash = record.pop("password_hash", None)
+        password = record.pop("password", None)
+        fields = {field.attname: field for field in User._meta.concrete_fields if field.attname != "password"}
+        unknown = set(record) - set(fields)
+        if unknown:
+            raise CommandError("Unknown user fields: {0}".format(", ".join(sorted(unknown))))
+        values = {}
+        for key, value in record.items():
+            if isinstance(fields[key], models.BooleanField) and isinstance(value, str):
+                # empty CSV cells keep the field default
+                value = cls.to_boolean(key, value) if value.strip() else None
+            if value is not None:
+                values[key] = value
+        user = User(**values)
+        if password_hash:
+            user.password = password_hash
+        elif password:
+            user.password = make_password(password)
+        else:
+            user.set_unusable_password()
+        return user
+
+    @staticmethod
+    def to_boolean(key, value):
+        value = value.strip().lower()
+        if value in ("1", "t", "true", "y", "yes"):
+            return True
+        if value in ("0", "f", "false", "n", "no"):
+            return False
+        raise CommandError('Invalid value "{0}" for {1}'.format(value, key))
@@ -0,0 +1,95 @@
+import csv
+import datetime
+import itertools
+
+from django.contrib.auth import get_user_model
+from django.contrib.sites.models import Site
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import F
+from django.urls import reverse
+from django.utils import timezone
+
+from account.conf import settings
+from account.hooks import hookset
+from account.utils import annotate_password_expiration
+
+
+class Command(BaseCommand):
+
+    help = "Write a CSV report of users whose password expires within the given number of days."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "-d", "--days",
+            type=int,
+            default=7,
+            help="report passwords expiring within this many days"
+        )
+        parser.add_argument(
+            "--include-expired",
+            action="store_true",
+            help="also report passwords that have already expired"
+        )
+        parser.add_argument(
+            "--send-warnings",
+            action="store_true",
+            help="email a warning to every reported user with an email address"
+        )
+        parser.add_argument(
+            "-b", "--batch-size",
+            type=int,
+            default=500,
+            help="number of warnings sent over one mail connection"
+        )
+
+    def handle(self, *args, **options):
+        if not settings.ACCOUNT_PASSWORD_USE_HISTORY:
+            # passwords never expire without password history
+            raise CommandError("Password expiry requires ACCOUNT_PASSWORD_USE_HISTORY.")
+        now = timezone.now()
+        users = annotate_password_expiration(get_user_model().objects.filter(is_active=True)).filter(
+            password_expiration__lte=now + datetime.timedelta(days=options["days"]),
+        )
+        if not options["include_expired"]:
+            users = users.filter(password_expiration__gt=now)
+        users = users.annotate(language=F("account__language")).order_by("password_expiration", "pk")
+
+        if options["send_warnings"]:
+            site = Site.objects.get_current()
+            password_change_url = "{0}://{1}{2}".format(
+                settings.ACCOUNT_DEFAULT_HTTP_PROTOCOL,
+                site.domain,
+                reverse("account_password"),
+            )
+
+        writer = csv.writer(self.stdout, lineterminator="\n")
+        writer.writerow(["id", "username", "email", "password_changed", "password_expiration"])
+        users = users.iterator(chunk_size=options["batch_size"])
+        count = 0
+        while True:
+            batch = list(itertools.islice(users, options["batch_size"]))
+            if not batch:
+                break
+            for user in batch:
+                writer.writerow([
+                    user.pk,
+                    user.get_username(),
+                    user.email,
+                    user.password_changed.isoformat(),
+                    user.password_expiration.isoformat(),
+                ])
+            if options["send_warnings"]:
+                batch = [user for user in batch if user.email]
+                hookset.send_password_expiry_warning_emails(
+                    ([user.email], {
+                        "user": user,
+                        "password_expiration": user.password_expiration,
+                        "password_change_url": password_change_url,
+                        "current_site": site,
+                    }, user.language)
+                    for user in batch
+                )
+                count += len(batch)
+
+        if options["send_warnings"]:
+            self.stderr.write("{0} password expiry warnings sent.".format(count))
@@ -0,0 +1,91 @@
+from django.core.management.base import BaseCommand
+from django.db import DatabaseError, connections, router
+from django.template.defaultfilters import filesizeformat
+
+from account.conf import settings
+from account.models import PasswordHistory
+
+
+class Command(BaseCommand):
+
+    help = "Delete password history outside the ACCOUNT_PASSWORD_HISTORY_KEEP retention policy."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "-k", "--keep",
+            type=int,
+            default=settings.ACCOUNT_PASSWORD_HISTORY_KEEP,
+            help="number of latest entries kept per user"
+        )
+        parser.add_argument(
+            "--keep-days",
+            type=int,
+            default=settings.ACCOUNT_PASSWORD_HISTORY_KEEP_DAYS,
+            help="entries newer than this many days are kept"
+        )
+        parser.add_argument(
+            "-b", "--batch-size",
+            type=int,
+            default=1000,
+            help="number of entries deleted per query"
+        )
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            help="only count the entries that would be deleted"
+        )
+
+    def handle(self, *args, **options):
+        keep, keep_days = options["keep"], options["keep_days"]
+        if keep is None and keep_days is None:
+            return "No password history retention policy set."
+        if options["dry_run"]:
+            count = PasswordHistory.objects.surplus(keep=keep, keep_days=keep_days).count()
+            return "{0} password history entries would be deleted.".format(count)
+
+        def progress(count):
+            self.stdout.write("{0} deleted so far".format(count))
+
+        count = PasswordHistory.objects.prune(
+            keep=keep,
+            keep_days=keep_days,
+            batch_size=options["batch_size"],
+            callback=progress,
+        )
+        remaining = PasswordHistory.objects.count()
+        size = self.table_size()
+        return "{0} password history entries deleted, {1} remaining{2}.".format(
+            count, remaining, "" if size is None else " ({0})".format(filesizeformat(size))
+        )
+
+    @staticmethod
+    def table_size():
+        """
+        Returns the size of the password history table, including its
+        indexes, in bytes where the database can report it.
+        """
+        connection = connections[router.db_for_write(PasswordHistory)]
+        table = PasswordHistory._meta.db_table
+        with connection.cursor() as cursor:
+            if connection.vendor == "postgresql":
+                cursor.execute("SELECT pg_total_relation_size(%s)", [table])
+            elif connection.vendor == "mysql":
+                cursor.execute(
+                    "SELECT data_length + index_length FROM information_schema.tables "
+                    "WHERE table_schema = DATABASE() AND table_name = %s",
+                    [table],
+                )
+            elif connection.vendor == "sqlite":
+                try:
+                    # dbstat is only available when SQLite is built with it
+                    cursor.execute(
+                        "SELECT SUM(pgsize) FROM dbstat WHERE name = %s "
+                        "OR name IN (SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = %s)",
+                        [table, table],
+                    )
+                except DatabaseError:
+                    return None
+            else:
+                return None
+            row = cursor.fetchone()
+        return row[0] if row else None
@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand
+
+from account.models import EmailConfirmation
+
+
+class Command(BaseCommand):
+
+    help = "Delete email confirmations older than ACCOUNT_EMAIL_CONFIRMATION_EXPIRE_DAYS."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "-b", "--batch-size",
+            type=int,
+            default=1000,
+            help="number of confirmations deleted per query"
+        )
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            help="only count the confirmations that would be deleted"
+        )
+
+    def handle(self, *args, **options):
+        if options["dry_run"]:
+            count = EmailConfirmation.objects.expired().count()
+            return "{0} expired email confirmations would be deleted.".format(count)
+        count = EmailConfirmation.objects.delete_expired_confirmations(batch_size=options["batch_size"])
+        return "{0} expired email confirmations deleted.".format(count)
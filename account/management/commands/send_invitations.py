@@ -0,0 +1,83 @@
+import time
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+
+from account.models import SignupCode
+from account.utils import open_records
+
+
+class Command(BaseCommand):
+
+    help = "Create and send signup codes for a CSV or JSON lines file of email addresses."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "path",
+            help="CSV file with an email column or JSON lines file of objects with an email key; - reads stdin"
+        )
+        parser.add_argument(
+            "--format",
+            choices=["csv", "jsonl"],
+            help="input format, guessed from the file extension by default"
+        )
+        parser.add_argument(
+            "-b", "--batch-size",
+            type=int,
+            default=500,
+            help="number of invitations created and sent per batch"
+        )
+        parser.add_argument(
+            "--inviter",
+            help="username of the user the invitations are sent from"
+        )
+        parser.add_argument(
+            "--expiry",
+            type=int,
+            default=24,
+            help="number of hours the signup codes are valid"
+        )
+        parser.add_argument(
+            "--max-uses",
+            type=int,
+            default=1,
+            help="number of times each signup code can be used (0 for unlimited)"
+        )
+        parser.add_argument(
+            "--notes",
+            default="",
+            help="notes stored on every signup code"
+        )
+
+    def handle(self, *args, **options):
+        inviter = None
+        if options["inviter"]:
+            User = get_user_model()
+            try:
+                inviter = User._default_manager.get_by_natural_key(options["inviter"])
+            except User.DoesNotExist:
+                raise CommandError('User "{}" not found'.format(options["inviter"]))
+
+        start = time.monotonic()
+
+        def progress(sent, skipped):
+            elapsed = time.monotonic() - start
+            self.stdout.write("{0} sent, {1} skipped ({2:.1f} invitations/s)".format(
+                sent, skipped, sent / elapsed if elapsed else 0
+            ))
+
+        with open_records(options["path"], options["format"]) as records:
+            emails = (
+                record if isinstance(record, str) else record.get("email") or ""
+                for record in records
+            )
+            sent, skipped = SignupCode.objects.bulk_invite(
+                emails,
+                batch_size=options["batch_size"],
+                callback=progress,
+                inviter=inviter,
+                expiry=options["expiry"],
+                max_uses=options["max_uses"],
+                notes=options["notes"],
+            )
+        return "{0} invitations sent, {1} skipped.".format(sent, skipped)
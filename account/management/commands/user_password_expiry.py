@@ -1,6 +1,10 @@
+import itertools
+import sys
+
 from django.contrib.auth import get_user_model
-from django.core.management.base import LabelCommand
+from django.core.management.base import CommandError, LabelCommand
 
+from account.cache import invalidate_password_expiry_many
 from account.conf import settings
 from account.models import PasswordExpiry
 
@@ -11,7 +15,7 @@ class Command(LabelCommand):
     label = "username"
 
     def add_arguments(self, parser):
-        super(Command, self).add_arguments(parser)
+        parser.add_argument("args", metavar=self.label, nargs="*")
         parser.add_argument(
             "-e", "--expire",
             type=int,
@@ -19,6 +23,32 @@ class Command(LabelCommand):
             default=settings.ACCOUNT_PASSWORD_EXPIRY,
             help="number of seconds until password expires"
         )
+        parser.add_argument(
+            "--file",
+            help="file with one username per line to set the expiry for in bulk; - reads stdin"
+        )
+        parser.add_argument(
+            "--group",
+            help="set the expiry in bulk for all members of this group"
+        )
+        parser.add_argument(
+            "--all-active",
+            action="store_true",
+            help="set the expiry in bulk for all active users"
+        )
+        parser.add_argument(
+            "-b", "--batch-size",
+            type=int,
+            default=1000,
+            help="number of users updated per batch in bulk mode"
+        )
+
+    def handle(self, *labels, **options):
+        if options["file"] or options["group"] or options["all_active"]:
+            return self.handle_bulk(labels, **options)
+        if not labels:
+            raise CommandError("Enter at least one {}, or use --file, --group or --all-active.".format(self.label))
+        return super().handle(*labels, **options)
 
     def handle_label(self, username, **options):
         User = get_user_model()
@@ -37,3 +67,55 @@ class Command(LabelCommand):
             user.password_expiry.save()
 
         return 'User "{}" password expiration set to {} seconds'.format(username, expire)
+
+    def handle_bulk(self, usernames, **options):
+        User = get_user_model()
+        expire = options["expire"]
+        batch_size = options["batch_size"]
+        updated = missing = 0
+
+        # usernames are resolved with one IN query per batch
+        stream = None
+        if options["file"]:
+            stream = sys.stdin if options["file"] == "-" else open(options["file"], encoding="utf-8")
+        try:
+            names = itertools.chain(usernames, (line.strip() for line in stream or [] if line.strip()))
+            while True:
+                chunk = set(itertools.islice(names, batch_size))
+                if not chunk:
+                    break
+                pks = list(User.objects.filter(username__in=chunk).values_list("pk", flat=True))
+                missing += len(chunk) - len(pks)
+                updated += self.set_expiry(pks, expire)
+        finally:
+            if stream is not None and stream is not sys.stdin:
+                stream.close()
+
+        if options["group"] or options["all_active"]:
+            users = User.objects.order_by("pk")
+            if options["group"]:
+                users = users.filter(groups__name=options["group"])
+            if options["all_active"]:
+                users = users.filter(is_active=True)
+            last_pk = None
+            while True:
+                batch = users if last_pk is None else users.filter(pk__gt=last_pk)
+                pks = list(batch.values_list("pk", flat=True)[:batch_size])
+                if not pks:
+                    break
+                updated += self.set_expiry(pks, expire)
+                last_pk = pks[-1]
+
+        return "Password expiration set to {} seconds for {} users, {} not found".format(expire, updated, missing)
+
+    @staticmethod
+    def set_expiry(pks, expire):
+        existing = set(PasswordExpiry.objects.filter(user_id__in=pks).values_list("user_id", flat=True))
+        PasswordExpiry.objects.filter(user_id__in=existing).update(expiry=expire)
+        PasswordExpiry.objects.bulk_create([
+            PasswordExpiry(user_id=pk, expiry=expire) for pk in pks if pk not in existing
+        ])
+        if settings.ACCOUNT_PASSWORD_USE_HISTORY:
+            # bulk queries do not send the signals that invalidate cached expiries
+            invalidate_password_expiry_many(pks)
+        return len(pks)
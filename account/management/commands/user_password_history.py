@@ -4,6 +4,8 @@ from django.contrib.auth import get_user_model
 from django.core.management.base import BaseCommand
 
 import pytz
+from account.cache import invalidate_password_expiry_many
+from account.conf import settings
 from account.models import PasswordHistory
 
 
@@ -24,22 +26,51 @@ class Command(BaseCommand):
             action="store_true",
             help="create new password history for all users, regardless of existing history"
         )
+        parser.add_argument(
+            "-b", "--batch-size",
+            type=int,
+            default=1000,
+            help="number of users handled per batch"
+        )
+        parser.add_argument(
+            "--start-pk",
+            type=int,
+            default=None,
+            help="only handle users with a pk greater than this, e.g. to resume an interrupted run"
+        )
 
     def handle(self, *args, **options):
         User = get_user_model()
-        users = User.objects.all()
+        users = User.objects.order_by("pk")
         if not options["force"]:
             users = users.filter(password_history=None)
 
-        if not users:
-            return "No users found without password history"
-
         days = options["days"]
         timestamp = datetime.datetime.now(tz=pytz.UTC) - datetime.timedelta(days=days)
+        batch_size = options["batch_size"]
 
-        # Create new PasswordHistory on `timestamp`
-        PasswordHistory.objects.bulk_create(
-            [PasswordHistory(user=user, timestamp=timestamp) for user in users]
-        )
+        # users are walked in pk order one page at a time so neither the
+        # users nor the new history rows are ever all held in memory
+        count = 0
+        last_pk = options["start_pk"]
+        while True:
+            batch = users if last_pk is None else users.filter(pk__gt=last_pk)
+            pks = list(batch.values_list("pk", flat=True)[:batch_size])
+            if not pks:
+                break
+            # Create new PasswordHistory on `timestamp`
+            PasswordHistory.objects.bulk_create(
+                [PasswordHistory(user_id=pk, timestamp=timestamp) for pk in pks],
+                batch_size=batch_size,
+            )
+            if settings.ACCOUNT_PASSWORD_USE_HISTORY:
+                # bulk_create does not send the signals that invalidate cached expiries
+                invalidate_password_expiry_many(pks)
+            count += len(pks)
+            last_pk = pks[-1]
+            self.stdout.write("{0} users done, up to pk {1}".format(count, last_pk))
+
+        if not count:
+            return "No users found without password history"
 
-        return "Password history set to {} for {} users".format(timestamp, len(users))
+        return "Password history set to {} for {} users".format(timestamp, count)
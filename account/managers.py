@@ -1,4 +1,134 @@
-from django.db import models
+import datetime
+import itertools
+
+from django.apps import apps
+from django.contrib.auth import get_user_model
+from django.contrib.sites.models import Site
+from django.db import models, transaction
+from django.db.models import Count, Exists, OuterRef, Q, Subquery, Value
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from account.cache import defer_password_expiry_invalidation
+from account.conf import settings
+from account.hooks import hookset
+from account.languages import DEFAULT_LANGUAGE
+from account.signals import signup_code_sent
+
+
+class AccountManager(models.Manager):
+
+    def bulk_provision(self, users, batch_size=1000, password_history=False, verified=False,
+                       callback=None, **kwargs):
+        """
+        Saves an iterable of unsaved users together with their accounts and
+        primary email addresses, batch_size users per transaction. Passwords
+        must already be set on the users. Unlike saving users one at a time
+        this bypasses user_post_save; remaining kwargs are used for every
+        Account. Returns the number of users created.
+        """
+        User = get_user_model()
+        EmailAddress = apps.get_model("account", "EmailAddress")
+        PasswordHistory = apps.get_model("account", "PasswordHistory")
+        kwargs.setdefault("language", DEFAULT_LANGUAGE)
+        users = iter(users)
+        count = 0
+        while True:
+            chunk = list(itertools.islice(users, batch_size))
+            if not chunk:
+                break
+            with transaction.atomic():
+                User._default_manager.bulk_create(chunk, batch_size=batch_size)
+                if chunk[0].pk is None:
+                    # the database cannot return primary keys from bulk inserts
+                    pks = dict(User._default_manager.filter(
+                        **{"{0}__in".format(User.USERNAME_FIELD): [user.get_username() for user in chunk]}
+                    ).values_list(User.USERNAME_FIELD, "pk"))
+                    for user in chunk:
+                        user.pk = pks[user.get_username()]
+                self.bulk_create([self.model(user=user, **kwargs) for user in chunk], batch_size=batch_size)
+                EmailAddress._default_manager.bulk_create([
+                    EmailAddress(user=user, email=user.email, primary=True, verified=verified)
+                    for user in chunk
+                    if user.email
+                ], batch_size=batch_size)
+                if password_history:
+                    PasswordHistory._default_manager.bulk_create([
+                        PasswordHistory(user=user, password=user.password)
+                        for user in chunk
+                        if user.has_usable_password()
+                    ], batch_size=batch_size)
+            count += len(chunk)
+            if callback is not None:
+                callback(count)
+        return count
+
+    def ensure_accounts(self, start_pk=None, end_pk=None, batch_size=1000, emails=True, callback=None):
+        """
+        Creates the missing accounts, and primary email addresses when emails
+        is true, for users with a pk between start_pk and end_pk. Users are
+        walked in pk order batch_size at a time so memory use stays constant;
+        callback receives the last pk of every batch so an interrupted run can
+        be resumed from it. Returns the number of accounts and email addresses
+        created.
+        """
+        User = get_user_model()
+        EmailAddress = apps.get_model("account", "EmailAddress")
+        users = User._default_manager.order_by("pk")
+        if end_pk is not None:
+            users = users.filter(pk__lte=end_pk)
+        accounts_created = emails_created = 0
+        last_pk = start_pk
+        while True:
+            batch = users if last_pk is None else users.filter(pk__gt=last_pk)
+            pks = list(batch.values_list("pk", flat=True)[:batch_size])
+            if not pks:
+                break
+            window = User._default_manager.filter(pk__gte=pks[0], pk__lte=pks[-1])
+            with transaction.atomic():
+                missing = list(window.filter(account__isnull=True).values_list("pk", flat=True))
+                if missing:
+                    self.bulk_create(
+                        [self.model(user_id=pk, language=DEFAULT_LANGUAGE) for pk in missing],
+                        ignore_conflicts=True,
+                    )
+                    # bulk_create returns every object when conflicts are
+                    # ignored, so the rows that were inserted are counted
+                    accounts_created += self.filter(user_id__in=missing).count()
+                if emails:
+                    emails_created += self.ensure_primary_emails(window, EmailAddress)
+            last_pk = pks[-1]
+            if callback is not None:
+                callback(last_pk, accounts_created, emails_created)
+        return accounts_created, emails_created
+
+    @staticmethod
+    def ensure_primary_emails(users, EmailAddress):
+        without_primary = users.exclude(email="").exclude(
+            Exists(EmailAddress._default_manager.filter(user=OuterRef("pk"), primary=True))
+        )
+        # an existing address for the user's email is promoted rather than duplicated
+        EmailAddress._default_manager.filter(
+            pk__in=EmailAddress._default_manager.filter(
+                user__in=without_primary,
+                email=models.F("user__email"),
+            ).values("pk")
+        ).update(primary=True)
+        taken = EmailAddress._default_manager.filter(email=OuterRef("email"))
+        if not settings.ACCOUNT_EMAIL_UNIQUE:
+            taken = taken.filter(user=OuterRef("pk"))
+        missing = without_primary.exclude(
+            Exists(EmailAddress._default_manager.filter(user=OuterRef("pk"), primary=True))
+        ).exclude(Exists(taken)).values_list("pk", "email")
+        missing = dict(missing)
+        if not missing:
+            return 0
+        EmailAddress._default_manager.bulk_create(
+            [EmailAddress(user_id=pk, email=email, primary=True) for pk, email in missing.items()],
+            ignore_conflicts=True,
+        )
+        # conflicting rows are skipped silently, so count what was inserted
+        return EmailAddress._default_manager.filter(user__in=list(missing), primary=True).count()
 
 
 class EmailAddressManager(models.Manager):
@@ -24,7 +154,134 @@ class EmailAddressManager(models.Manager):
 
 class EmailConfirmationManager(models.Manager):
 
-    def delete_expired_confirmations(self):
-        for confirmation in self.all():
-            if confirmation.key_expired():
-                confirmation.delete()
+    def expired(self):
+        """
+        Confirmations sent more than ACCOUNT_EMAIL_CONFIRMATION_EXPIRE_DAYS
+        ago, and never-sent confirmations created before then.
+        """
+        cutoff = timezone.now() - datetime.timedelta(days=settings.ACCOUNT_EMAIL_CONFIRMATION_EXPIRE_DAYS)
+        return self.filter(Q(sent__lte=cutoff) | Q(sent__isnull=True, created__lte=cutoff))
+
+    def delete_expired_confirmations(self, batch_size=1000):
+        """
+        Deletes expired confirmations in batches and returns how many were
+        deleted.
+        """
+        expired = self.expired()
+        count = 0
+        while True:
+            pks = list(expired.values_list("pk", flat=True)[:batch_size])
+            if not pks:
+                break
+            count += self.filter(pk__in=pks).delete()[0]
+        return count
+
+
+class SignupCodeManager(models.Manager):
+
+    def bulk_invite(self, emails, batch_size=500, site=None, callback=None, **kwargs):
+        """
+        Creates and sends a signup code for every address in emails that was
+        not sent one yet. Unexpired codes that were created but never sent,
+        e.g. by a run that failed while sending, are sent instead of creating
+        new ones. ``emails`` is consumed in chunks of batch_size so it can be
+        a stream of any length; each chunk costs one query to find existing
+        codes, one insert, one update and one mail connection. Remaining
+        kwargs are passed to SignupCode.create. Returns the number of
+        invitations sent and of addresses skipped.
+        """
+        if site is None:
+            site = Site.objects.get_current()
+        emails = iter(emails)
+        sent = skipped = 0
+        while True:
+            chunk = list(itertools.islice(emails, batch_size))
+            if not chunk:
+                break
+            # dict keeps the input order while dropping duplicates in the chunk
+            chunk = list(dict.fromkeys(email.strip() for email in chunk if email.strip()))
+            codes, created = self.invite_codes(chunk, **kwargs)
+            skipped += len(chunk) - len(codes)
+            if codes:
+                self.bulk_create(created)
+                hookset.send_invitation_emails(
+                    ([code.email], {
+                        "signup_code": code,
+                        "current_site": site,
+                        "signup_url": code.get_signup_url(site),
+                    }, None)
+                    for code in codes
+                )
+                now = timezone.now()
+                self.filter(code__in=[code.code for code in codes]).update(sent=now)
+                for code in codes:
+                    code.sent = now
+                    signup_code_sent.send(sender=self.model, signup_code=code)
+                sent += len(codes)
+            if callback is not None:
+                callback(sent, skipped)
+        return sent, skipped
+
+    def invite_codes(self, emails, **kwargs):
+        """
+        Returns the codes to send to emails, reusing unexpired unsent codes
+        and leaving out addresses that were already sent one, together with
+        the new unsaved codes among them.
+        """
+        now = timezone.now()
+        invited, unsent = set(), {}
+        for code in self.filter(email__in=emails):
+            if code.sent is not None:
+                invited.add(code.email)
+            elif code.expiry is None or code.expiry > now:
+                unsent[code.email] = code
+        codes, created = [], []
+        for email in emails:
+            if email in invited:
+                continue
+            code = unsent.get(email)
+            if code is None:
+                code = self.model.create(email=email, check_exists=False, **kwargs)
+                created.append(code)
+            codes.append(code)
+        return codes, created
+
+
+class PasswordHistoryManager(models.Manager):
+
+    def surplus(self, keep=None, keep_days=None):
+        """
+        Returns the history entries outside the retention policy: entries
+        with at least ``keep`` newer entries for the same user that are also
+        older than ``keep_days`` days. The latest entry of every user is
+        always kept since it is used to check password expiry.
+        """
+        keep = max(keep or 1, 1)
+        # entries for the same user ordered after this one by (timestamp, pk)
+        newer = self.filter(user=OuterRef("user")).filter(
+            Q(timestamp__gt=OuterRef("timestamp")) | Q(timestamp=OuterRef("timestamp"), pk__gt=OuterRef("pk"))
+        ).order_by().values("user").annotate(count=Count("pk")).values("count")
+        surplus = self.alias(newer=Coalesce(Subquery(newer), Value(0))).filter(newer__gte=keep)
+        if keep_days is not None:
+            surplus = surplus.filter(timestamp__lt=timezone.now() - datetime.timedelta(days=keep_days))
+        return surplus
+
+    def prune(self, keep=None, keep_days=None, batch_size=1000, callback=None):
+        """
+        Deletes the entries returned by surplus in batches and returns the
+        number of entries deleted.
+        """
+        surplus = self.surplus(keep=keep, keep_days=keep_days).order_by("pk")
+        count = 0
+        last_pk = None
+        while True:
+            batch = surplus if last_pk is None else surplus.filter(pk__gt=last_pk)
+            pks = list(batch.values_list("pk", flat=True)[:batch_size])
+            if not pks:
+                break
+            with defer_password_expiry_invalidation():
+                count += self.filter(pk__in=pks).delete()[0]
+            last_pk = pks[-1]
+            if callback is not None:
+                callback(count)
+        return count
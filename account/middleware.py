@@ -3,7 +3,7 @@ from urllib.parse import urlparse, urlunparse
 from django.contrib import messages
 from django.contrib.auth import REDIRECT_FIELD_NAME
 from django.http import HttpResponseRedirect, QueryDict
-from django.urls import resolve, reverse
+from django.urls import reverse
 from django.utils import timezone, translation
 from django.utils.cache import patch_vary_headers
 from django.utils.deprecation import MiddlewareMixin as BaseMiddleware
@@ -12,7 +12,7 @@ from django.utils.translation import gettext_lazy as _
 from account import signals
 from account.conf import settings
 from account.models import Account
-from account.utils import check_password_expired
+from account.utils import check_session_password_expired
 
 
 class LocaleMiddleware(BaseMiddleware):
@@ -28,8 +28,7 @@ class LocaleMiddleware(BaseMiddleware):
     def get_language_for_user(request):
         if request.user.is_authenticated:
             try:
-                account = Account.objects.get(user=request.user)
-                return account.language
+                return Account.for_request(request).language
             except Account.DoesNotExist:
                 pass
         return translation.get_language_from_request(request)
@@ -54,40 +53,70 @@ class TimezoneMiddleware(BaseMiddleware):
 
     @staticmethod
     def process_request(request):
+        if not request.user.is_authenticated:
+            return
         try:
-            account = getattr(request.user, "account", None)
+            account = Account.for_request(request)
         except Account.DoesNotExist:
             pass
         else:
-            if account:
-                tz = settings.TIME_ZONE if not account.timezone else account.timezone
-                timezone.activate(tz)
+            tz = settings.TIME_ZONE if not account.timezone else account.timezone
+            timezone.activate(tz)
 
 
-class ExpiredPasswordMiddleware(BaseMiddleware):
+class AccountMiddleware(LocaleMiddleware):
+    """
+    Combines LocaleMiddleware and TimezoneMiddleware. The account is loaded
+    once per request and shared with the ``account`` context processor.
+    """
 
     def process_request(self, request):
+        super(AccountMiddleware, self).process_request(request)
+        TimezoneMiddleware.process_request(request)
+
+
+class ExpiredPasswordMiddleware(BaseMiddleware):
+    """
+    Redirects users with an expired password to the change password page.
+
+    The change password and log out URLs are always exempt. Additional URL
+    names and path prefixes (``STATIC_URL`` and ``MEDIA_URL`` are included)
+    are precomputed once so exempt requests skip the expiry check entirely.
+    """
+
+    def __init__(self, get_response=None):
+        super(ExpiredPasswordMiddleware, self).__init__(get_response)
+        # Authenticated users must be allowed to access
+        # "change password" page and "log out" page.
+        # even if password is expired.
+        self.exempt_url_names = frozenset([
+            settings.ACCOUNT_PASSWORD_CHANGE_REDIRECT_URL,
+            settings.ACCOUNT_LOGOUT_URL,
+        ] + list(settings.ACCOUNT_PASSWORD_EXPIRY_EXEMPT_URL_NAMES))
+        exempt_paths = list(settings.ACCOUNT_PASSWORD_EXPIRY_EXEMPT_PATHS)
+        for url in [settings.STATIC_URL, settings.MEDIA_URL]:
+            if url and url.startswith("/") and url != "/":
+                exempt_paths.append(url)
+        self.exempt_paths = tuple(exempt_paths)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if request.path.startswith(self.exempt_paths):
+            return
         if request.user.is_authenticated and not request.user.is_staff:
-            next_url = resolve(request.path).url_name
-            # Authenticated users must be allowed to access
-            # "change password" page and "log out" page.
-            # even if password is expired.
-            if next_url not in [
-                settings.ACCOUNT_PASSWORD_CHANGE_REDIRECT_URL,
-                settings.ACCOUNT_LOGOUT_URL,
-            ] and check_password_expired(request.user):
-                    signals.password_expired.send(sender=self, user=request.user)
-                    messages.add_message(
-                        request,
-                        messages.WARNING,
-                        _("Your password has expired. Please save a new password.")
-                    )
-                    redirect_field_name = REDIRECT_FIELD_NAME
-
-                    change_password_url = reverse(settings.ACCOUNT_PASSWORD_CHANGE_REDIRECT_URL)
-                    url_bits = list(urlparse(change_password_url))
-                    querystring = QueryDict(url_bits[4], mutable=True)
-                    querystring[redirect_field_name] = next_url
-                    url_bits[4] = querystring.urlencode(safe="/")
-
-                    return HttpResponseRedirect(urlunparse(url_bits))
+            next_url = request.resolver_match.url_name
+            if next_url not in self.exempt_url_names and check_session_password_expired(request):
+                signals.password_expired.send(sender=self, user=request.user)
+                messages.add_message(
+                    request,
+                    messages.WARNING,
+                    _("Your password has expired. Please save a new password.")
+                )
+                redirect_field_name = REDIRECT_FIELD_NAME
+
+                change_password_url = reverse(settings.ACCOUNT_PASSWORD_CHANGE_REDIRECT_URL)
+                url_bits = list(urlparse(change_password_url))
+                querystring = QueryDict(url_bits[4], mutable=True)
+                querystring[redirect_field_name] = next_url
+                url_bits[4] = querystring.urlencode(safe="/")
+
+                return HttpResponseRedirect(urlunparse(url_bits))
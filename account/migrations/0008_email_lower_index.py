@@ -0,0 +1,48 @@
+# Generated by Django 4.2.30 on 2026-10-18 16:43
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import migrations, models
+import django.db.models.functions.text
+
+USERNAME_INDEX_NAME = 'account_username_lower_idx'
+
+
+def username_index():
+    username_field = getattr(get_user_model(), 'USERNAME_FIELD', 'username')
+    return models.Index(django.db.models.functions.text.Lower(username_field), name=USERNAME_INDEX_NAME)
+
+
+def add_username_index(apps, schema_editor):
+    User = apps.get_model(settings.AUTH_USER_MODEL)
+    schema_editor.add_index(User, username_index())
+
+
+def remove_username_index(apps, schema_editor):
+    User = apps.get_model(settings.AUTH_USER_MODEL)
+    schema_editor.remove_index(User, username_index())
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('account', '0007_alter_emailconfirmation_sent'),
+    ]
+
+    if settings.AUTH_USER_MODEL == 'auth.User':
+        # run after the auth migrations that rebuild the user table on SQLite
+        dependencies.append(('auth', '0012_alter_user_first_name_max_length'))
+
+    operations = [
+        migrations.AddIndex(
+            model_name='emailaddress',
+            index=models.Index(django.db.models.functions.text.Lower('email'), name='account_email_lower_idx'),
+        ),
+        # the user model belongs to another app so its index is created
+        # directly on the table rather than through the migration state.
+        # makemigrations cannot see it, and on SQLite a later AlterField on
+        # the user model rebuilds the table without it; see the FAQ for how
+        # to recreate it.
+        migrations.RunPython(add_username_index, remove_username_index),
+    ]
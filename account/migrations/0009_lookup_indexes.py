@@ -0,0 +1,56 @@
+# Generated by Django 4.2.30 on 2026-10-18 16:44
+
+from django.db import migrations, models
+
+
+def demote_duplicate_primaries(apps, schema_editor):
+    """
+    Keep a single primary address per user so the partial unique constraint
+    can be created. The address matching the user's email wins, otherwise the
+    most recent one.
+    """
+    EmailAddress = apps.get_model('account', 'EmailAddress')
+    duplicates = (
+        EmailAddress.objects.filter(primary=True)
+        .values('user')
+        .annotate(n=models.Count('id'))
+        .filter(n__gt=1)
+        .values_list('user', flat=True)
+    )
+    for user_id in duplicates.iterator():
+        addresses = list(
+            EmailAddress.objects.filter(user_id=user_id, primary=True).select_related('user').order_by('-id')
+        )
+        keep = next((a for a in addresses if a.email == getattr(a.user, 'email', None)), addresses[0])
+        EmailAddress.objects.filter(user_id=user_id, primary=True).exclude(pk=keep.pk).update(primary=False)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('account', '0008_email_lower_index'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='accountdeletion',
+            index=models.Index(condition=models.Q(('user__isnull', False)), fields=['date_requested'], name='account_deletion_pending_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='emailconfirmation',
+            index=models.Index(fields=['sent'], name='account_confirmation_sent_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='passwordhistory',
+            index=models.Index(fields=['user', '-timestamp'], name='account_pwhistory_latest_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='signupcode',
+            index=models.Index(fields=['email'], name='account_signupcode_email_idx'),
+        ),
+        migrations.RunPython(demote_duplicate_primaries, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='emailaddress',
+            constraint=models.UniqueConstraint(condition=models.Q(('primary', True)), fields=('user',), name='account_email_one_primary'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 4.2.30 on 2026-10-18 16:48
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('account', '0009_lookup_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='accountdeletion',
+            name='lease_expires',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='accountdeletion',
+            name='lease_token',
+            field=models.CharField(blank=True, editable=False, max_length=32),
+        ),
+    ]
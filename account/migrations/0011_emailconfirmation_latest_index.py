@@ -0,0 +1,17 @@
+# Generated by Django 4.2.30 on 2026-10-18 16:52
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('account', '0010_accountdeletion_lease'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='emailconfirmation',
+            index=models.Index(fields=['email_address', '-sent'], name='account_confirm_latest_idx'),
+        ),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 4.2.30 on 2026-10-18 16:55
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('account', '0011_emailconfirmation_latest_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EmailOutbox',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('subject', models.TextField()),
+                ('message', models.TextField()),
+                ('from_email', models.CharField(max_length=254)),
+                ('to', models.JSONField(default=list)),
+                ('created', models.DateTimeField(default=django.utils.timezone.now)),
+                ('sent', models.DateTimeField(blank=True, null=True)),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('next_attempt', models.DateTimeField(default=django.utils.timezone.now)),
+                ('last_error', models.TextField(blank=True)),
+                ('lease_token', models.CharField(blank=True, editable=False, max_length=32)),
+                ('lease_expires', models.DateTimeField(blank=True, editable=False, null=True)),
+            ],
+            options={
+                'verbose_name': 'email outbox',
+                'verbose_name_plural': 'email outbox',
+                'indexes': [models.Index(condition=models.Q(('sent__isnull', True)), fields=['next_attempt'], name='account_outbox_due_idx')],
+            },
+        ),
+    ]
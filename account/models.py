@@ -1,14 +1,19 @@
 import datetime
 import functools
 import operator
+import uuid
 from urllib.parse import urlencode
 
 from django import forms
 from django.contrib.auth.models import AnonymousUser
 from django.contrib.sites.models import Site
-from django.db import models, transaction
-from django.db.models import Q
-from django.db.models.signals import post_save
+from django.core import signing
+from django.core.mail import EmailMessage, get_connection
+from django.core.signals import setting_changed
+from django.db import connections, models, router, transaction
+from django.db.models import F, Q, Value
+from django.db.models.functions import Lower
+from django.db.models.signals import post_delete, post_save
 from django.dispatch import receiver
 from django.urls import reverse
 from django.utils import timezone, translation
@@ -16,11 +21,18 @@ from django.utils.translation import gettext_lazy as _
 
 import pytz
 from account import signals
+from account.cache import invalidate_password_expiry, password_expiry_deferred, user_cache
 from account.conf import settings
 from account.fields import TimeZoneField
 from account.hooks import hookset
 from account.languages import DEFAULT_LANGUAGE
-from account.managers import EmailAddressManager, EmailConfirmationManager
+from account.managers import (
+    AccountManager,
+    EmailAddressManager,
+    EmailConfirmationManager,
+    PasswordHistoryManager,
+    SignupCodeManager,
+)
 from account.signals import signup_code_sent, signup_code_used
 
 
@@ -40,14 +52,26 @@ class Account(models.Model):
         default=DEFAULT_LANGUAGE,
     )
 
+    objects = AccountManager()
+
     @classmethod
     def for_request(cls, request):
+        """
+        Returns the account for the request's user. The result is memoized on
+        the request so the middleware and the context processor share a
+        single lookup.
+        """
         user = getattr(request, "user", None)
+        cached = getattr(request, "_cached_account", None)
+        if cached is not None and cached[0] is user:
+            return cached[1]
+        account = None
         if user and user.is_authenticated:
             account = user.account
-            if account:
-                return account
-        return AnonymousAccount(request)
+        if not account:
+            account = AnonymousAccount(request)
+        request._cached_account = (user, account)
+        return account
 
     @classmethod
     def create(cls, request=None, **kwargs):
@@ -110,6 +134,18 @@ def user_post_save(*args, **kwargs):
         Account.create(user=user)
 
 
+@receiver([post_save, post_delete], sender=settings.AUTH_USER_MODEL)
+def user_cache_invalidate(sender, instance, **kwargs):
+    if settings.ACCOUNT_USER_CACHE:
+        user_cache.invalidate(instance.pk)
+
+
+@receiver([post_save, post_delete], sender=Account)
+def account_cache_invalidate(sender, instance, **kwargs):
+    if settings.ACCOUNT_USER_CACHE:
+        user_cache.invalidate(instance.user_id)
+
+
 class AnonymousAccount:
 
     def __init__(self, request=None):
@@ -132,6 +168,9 @@ class SignupCode(models.Model):
     class InvalidCode(Exception):
         pass
 
+    class Exhausted(InvalidCode):
+        pass
+
     code = models.CharField(_("code"), max_length=64, unique=True)
     max_uses = models.PositiveIntegerField(_("max uses"), default=1)
     expiry = models.DateTimeField(_("expiry"), null=True, blank=True)
@@ -142,9 +181,14 @@ class SignupCode(models.Model):
     created = models.DateTimeField(_("created"), default=timezone.now, editable=False)
     use_count = models.PositiveIntegerField(_("use count"), editable=False, default=0)
 
+    objects = SignupCodeManager()
+
     class Meta:
         verbose_name = _("signup code")
         verbose_name_plural = _("signup codes")
+        indexes = [
+            models.Index(fields=["email"], name="account_signupcode_email_idx"),
+        ]
 
     def __str__(self):
         if self.email:
@@ -203,23 +247,37 @@ class SignupCode(models.Model):
     def use(self, user):
         """
         Add a SignupCode result attached to the given user.
+
+        The use count is incremented with a single conditional UPDATE so
+        concurrent redemptions can never exceed max_uses. Raises
+        SignupCode.Exhausted when no uses are left.
         """
-        result = SignupCodeResult()
-        result.signup_code = self
-        result.user = user
-        result.save()
+        available = Q(max_uses=0) | Q(use_count__lt=F("max_uses"))
+        with transaction.atomic():
+            updated = SignupCode._default_manager.filter(available, pk=self.pk).update(use_count=F("use_count") + 1)
+            if not updated:
+                raise self.Exhausted()
+            self.refresh_from_db(fields=["use_count"])
+            result = SignupCodeResult()
+            result.signup_code = self
+            result.user = user
+            # already counted by the UPDATE above
+            result._use_counted = True
+            result.save()
         signup_code_used.send(sender=result.__class__, signup_code_result=result)
 
+    def get_signup_url(self, site):
+        return "{0}://{1}{2}?{3}".format(
+            settings.ACCOUNT_DEFAULT_HTTP_PROTOCOL,
+            site.domain,
+            reverse("account_signup"),
+            urlencode({"code": self.code})
+        )
+
     def send(self, **kwargs):
-        protocol = settings.ACCOUNT_DEFAULT_HTTP_PROTOCOL
         current_site = kwargs["site"] if "site" in kwargs else Site.objects.get_current()
         if "signup_url" not in kwargs:
-            signup_url = "{0}://{1}{2}?{3}".format(
-                protocol,
-                current_site.domain,
-                reverse("account_signup"),
-                urlencode({"code": self.code})
-            )
+            signup_url = self.get_signup_url(current_site)
         else:
             signup_url = kwargs["signup_url"]
         ctx = {
@@ -242,7 +300,9 @@ class SignupCodeResult(models.Model):
 
     def save(self, **kwargs):
         super(SignupCodeResult, self).save(**kwargs)
-        self.signup_code.calculate_use_count()
+        # results created outside SignupCode.use, e.g. in the admin
+        if not getattr(self, "_use_counted", False):
+            self.signup_code.calculate_use_count()
 
 
 class EmailAddress(models.Model):
@@ -257,6 +317,18 @@ class EmailAddress(models.Model):
     class Meta:
         verbose_name = _("email address")
         verbose_name_plural = _("email addresses")
+        indexes = [
+            # supports case-insensitive lookups, see account.utils.iexact
+            models.Index(Lower("email"), name="account_email_lower_idx"),
+        ]
+        constraints = [
+            # one primary address per user; also serves get_primary
+            models.UniqueConstraint(
+                fields=["user"],
+                condition=Q(primary=True),
+                name="account_email_one_primary",
+            ),
+        ]
         if not settings.ACCOUNT_EMAIL_UNIQUE:
             unique_together = [("user", "email")]
 
@@ -277,6 +349,34 @@ class EmailAddress(models.Model):
         return True
 
     def send_confirmation(self, **kwargs):
+        """
+        Sends a confirmation for this address and returns it.
+
+        With ACCOUNT_EMAIL_CONFIRMATION_SIGNED the confirmation is not stored
+        (see SignedEmailConfirmation).
+
+        With ACCOUNT_EMAIL_CONFIRMATION_REUSE the latest unexpired
+        confirmation is sent again instead of creating a new one. Nothing is
+        sent if one was sent within ACCOUNT_EMAIL_CONFIRMATION_RESEND_INTERVAL
+        seconds.
+        """
+        if settings.ACCOUNT_EMAIL_CONFIRMATION_SIGNED:
+            confirmation = SignedEmailConfirmation.create(self)
+            confirmation.send(**kwargs)
+            return confirmation
+        reuse = settings.ACCOUNT_EMAIL_CONFIRMATION_REUSE
+        interval = settings.ACCOUNT_EMAIL_CONFIRMATION_RESEND_INTERVAL
+        if reuse or interval:
+            now = timezone.now()
+            cutoff = now - datetime.timedelta(days=settings.ACCOUNT_EMAIL_CONFIRMATION_EXPIRE_DAYS)
+            latest = EmailConfirmation.objects.filter(email_address=self, sent__gt=cutoff).order_by("-sent").first()
+            if latest is not None:
+                if interval and latest.sent > now - datetime.timedelta(seconds=interval):
+                    return latest
+                if reuse:
+                    latest.email_address = self
+                    latest.send(**kwargs)
+                    return latest
         confirmation = EmailConfirmation.create(self)
         confirmation.send(**kwargs)
         return confirmation
@@ -291,13 +391,16 @@ class EmailAddress(models.Model):
             self.email = new_email
             self.verified = False
             self.save()
+            # confirmations sent to the previous email must neither confirm
+            # the new one nor be resent to it
+            EmailConfirmation.objects.filter(email_address=self).delete()
             if confirm:
                 self.send_confirmation()
 
     def validate_unique(self, exclude=None):
         super(EmailAddress, self).validate_unique(exclude=exclude)
 
-        qs = EmailAddress.objects.filter(email__iexact=self.email)
+        qs = EmailAddress.objects.alias(email_lower=Lower("email")).filter(email_lower=Lower(Value(self.email)))
 
         if qs.exists() and settings.ACCOUNT_EMAIL_UNIQUE:
             raise forms.ValidationError({
@@ -317,6 +420,10 @@ class EmailConfirmation(models.Model):
     class Meta:
         verbose_name = _("email confirmation")
         verbose_name_plural = _("email confirmations")
+        indexes = [
+            models.Index(fields=["sent"], name="account_confirmation_sent_idx"),
+            models.Index(fields=["email_address", "-sent"], name="account_confirm_latest_idx"),
+        ]
 
     def __str__(self):
         return "confirmation for {0}".format(self.email_address)
@@ -361,30 +468,217 @@ class EmailConfirmation(models.Model):
         signals.email_confirmation_sent.send(sender=self.__class__, confirmation=self)
 
 
+class SignedEmailConfirmation:
+    """
+    An email confirmation that is never stored. The key is a signed token
+    over the address and the time it was sent, so it is verified without
+    touching the EmailConfirmation table.
+    """
+
+    salt = "account.SignedEmailConfirmation"
+
+    def __init__(self, email_address, sent=None, key=None):
+        self.email_address = email_address
+        self.sent = sent
+        self.key = key
+
+    def __str__(self):
+        return "confirmation for {0}".format(self.email_address)
+
+    @classmethod
+    def create(cls, email_address):
+        return cls(email_address)
+
+    @classmethod
+    def from_key(cls, key):
+        """
+        Returns the confirmation for a signed key, or None if the key is not
+        valid or its address has changed since it was sent.
+        """
+        try:
+            pk, email, timestamp = signing.Signer(salt=cls.salt).unsign_object(key)
+        except (signing.BadSignature, TypeError, ValueError):
+            return None
+        email_address = EmailAddress.objects.select_related("user").filter(pk=pk, email=email).first()
+        if email_address is None:
+            return None
+        sent = datetime.datetime.fromtimestamp(timestamp, tz=datetime.timezone.utc)
+        return cls(email_address, sent=sent, key=key)
+
+    def key_expired(self):
+        expiration_date = self.sent + datetime.timedelta(days=settings.ACCOUNT_EMAIL_CONFIRMATION_EXPIRE_DAYS)
+        return expiration_date <= timezone.now()
+    key_expired.boolean = True
+
+    def confirm(self):
+        if not self.key_expired() and not self.email_address.verified:
+            email_address = self.email_address
+            email_address.verified = True
+            email_address.set_as_primary(conditional=True)
+            email_address.save()
+            signals.email_confirmed.send(sender=EmailConfirmation, email_address=email_address)
+            return email_address
+
+    def send(self, **kwargs):
+        self.sent = timezone.now()
+        self.key = signing.Signer(salt=self.salt).sign_object(
+            [self.email_address.pk, self.email_address.email, int(self.sent.timestamp())],
+            compress=True,
+        )
+        current_site = kwargs["site"] if "site" in kwargs else Site.objects.get_current()
+        protocol = settings.ACCOUNT_DEFAULT_HTTP_PROTOCOL
+        activate_url = "{0}://{1}{2}".format(
+            protocol,
+            current_site.domain,
+            reverse(settings.ACCOUNT_EMAIL_CONFIRMATION_URL, args=[self.key])
+        )
+        ctx = {
+            "email_address": self.email_address,
+            "user": self.email_address.user,
+            "activate_url": activate_url,
+            "current_site": current_site,
+            "key": self.key,
+        }
+        hookset.send_confirmation_email([self.email_address.email], ctx)
+        signals.email_confirmation_sent.send(sender=EmailConfirmation, confirmation=self)
+
+
+def lease_rows(queryset, batch_size, seconds, skip_locked=False):
+    """
+    Claims up to batch_size rows of queryset by stamping their lease_token
+    and lease_expires fields. Leases are committed before the rows are
+    processed and expire after the given number of seconds so rows held by
+    a crashed worker are picked up again.
+
+    With skip_locked, candidates are selected with SELECT ... FOR UPDATE
+    SKIP LOCKED so concurrent claims pass over each other's rows instead of
+    competing for them. The locks are only held until the lease is stamped.
+    """
+    model = queryset.model
+    now = timezone.now()
+    token = uuid.uuid4().hex
+    available = Q(lease_expires__isnull=True) | Q(lease_expires__lt=now)
+    with transaction.atomic():
+        candidates = queryset.filter(available).order_by("pk")
+        if skip_locked:
+            candidates = candidates.select_for_update(skip_locked=True)
+        candidates = list(candidates.values_list("pk", flat=True)[:batch_size])
+        model._default_manager.filter(available, pk__in=candidates).update(
+            lease_token=token,
+            lease_expires=now + datetime.timedelta(seconds=seconds),
+        )
+    return list(queryset.filter(lease_token=token).order_by("pk"))
+
+
 class AccountDeletion(models.Model):
 
     user = models.ForeignKey(settings.AUTH_USER_MODEL, null=True, blank=True, on_delete=models.SET_NULL)
     email = models.EmailField(max_length=254)
     date_requested = models.DateTimeField(_("date requested"), default=timezone.now)
     date_expunged = models.DateTimeField(_("date expunged"), null=True, blank=True)
+    # used to claim batches for expunge_deleted --worker
+    lease_token = models.CharField(max_length=32, blank=True, editable=False)
+    lease_expires = models.DateTimeField(null=True, blank=True, editable=False)
 
     class Meta:
         verbose_name = _("account deletion")
         verbose_name_plural = _("account deletions")
+        indexes = [
+            # pending deletions, see expunge
+            models.Index(
+                fields=["date_requested"],
+                condition=Q(user__isnull=False),
+                name="account_deletion_pending_idx",
+            ),
+        ]
 
     @classmethod
-    def expunge(cls, hours_ago=None):
+    def expunge(cls, hours_ago=None, batch_size=None, callback=None, worker=False):
+        """
+        Expunges accounts whose deletion was requested more than hours_ago.
+
+        With batch_size, deletions are processed in chunks (see
+        expunge_many). ``callback`` is called with the running count after
+        each chunk.
+
+        With worker, each chunk is leased first so several processes can
+        share the pending deletions (see lease).
+        """
         if hours_ago is None:
             hours_ago = settings.ACCOUNT_DELETION_EXPUNGE_HOURS
         before = timezone.now() - datetime.timedelta(hours=hours_ago)
+        pending = cls.objects.filter(date_requested__lt=before, user__isnull=False)
+        if worker:
+            return cls.expunge_batches(pending, batch_size or 100, callback, claim=True)
+        if batch_size:
+            return cls.expunge_batches(pending, batch_size, callback)
         count = 0
-        for account_deletion in cls.objects.filter(date_requested__lt=before, user__isnull=False):
+        for account_deletion in pending:
             hookset.account_delete_expunge(account_deletion)
-            account_deletion.date_expunged = timezone.now()
-            account_deletion.save()
+            # the user is gone so only the timestamp is written
+            cls.objects.filter(pk=account_deletion.pk).update(date_expunged=timezone.now())
             count += 1
         return count
 
+    @classmethod
+    def expunge_batches(cls, pending, batch_size, callback=None, claim=False):
+        count = 0
+        last_pk = None
+        while True:
+            # keyset pagination keeps memory flat while rows are modified
+            batch = pending.order_by("pk")
+            if last_pk is not None:
+                batch = batch.filter(pk__gt=last_pk)
+            if claim:
+                deletions = cls.lease(batch, batch_size)
+            else:
+                deletions = list(batch.select_related("user")[:batch_size])
+            cls.expunge_many(deletions)
+            if not deletions:
+                break
+            last_pk = deletions[-1].pk
+            count += len(deletions)
+            if callback is not None:
+                callback(count)
+        return count
+
+    @classmethod
+    def expunge_many(cls, deletions):
+        """
+        Expunges a chunk of deletions. With
+        ``ACCOUNT_DELETION_EXPUNGE_RELATED_BATCH_SIZE``, rows referencing the users
+        are first purged by ``hookset.account_delete_related`` in short
+        transactions of their own. The users are then deleted by
+        ``hookset.account_delete_expunge_many`` and the deletions stamped in
+        a single transaction.
+        """
+        if not deletions:
+            return
+        if settings.ACCOUNT_DELETION_EXPUNGE_RELATED_BATCH_SIZE:
+            for deletion in deletions:
+                hookset.account_delete_related(deletion.user)
+        with transaction.atomic():
+            hookset.account_delete_expunge_many(deletions)
+            cls.objects.filter(pk__in=[d.pk for d in deletions]).update(
+                date_expunged=timezone.now(),
+                lease_token="",
+                lease_expires=None,
+            )
+
+    @classmethod
+    def lease(cls, pending, batch_size):
+        """
+        Claims up to batch_size pending deletions for
+        ``ACCOUNT_DELETION_EXPUNGE_LEASE`` seconds (see lease_rows).
+        """
+        skip_locked = connections[router.db_for_write(cls)].features.has_select_for_update_skip_locked
+        return lease_rows(
+            pending.select_related("user"),
+            batch_size,
+            settings.ACCOUNT_DELETION_EXPUNGE_LEASE,
+            skip_locked=skip_locked,
+        )
+
     @classmethod
     def mark(cls, user):
         account_deletion, created = cls.objects.get_or_create(user=user)  # skipcq: PYL-W0612
@@ -401,11 +695,16 @@ class PasswordHistory(models.Model):
     class Meta:
         verbose_name = _("password history")
         verbose_name_plural = _("password histories")
+        indexes = [
+            models.Index(fields=["user", "-timestamp"], name="account_pwhistory_latest_idx"),
+        ]
 
     user = models.ForeignKey(settings.AUTH_USER_MODEL, related_name="password_history", on_delete=models.CASCADE)
     password = models.CharField(max_length=255)  # encrypted password
     timestamp = models.DateTimeField(default=timezone.now)  # password creation time
 
+    objects = PasswordHistoryManager()
+
 
 class PasswordExpiry(models.Model):
     """
@@ -418,3 +717,126 @@ class PasswordExpiry(models.Model):
         on_delete=models.CASCADE,
     )
     expiry = models.PositiveIntegerField(default=0)
+
+
+def password_expiry_invalidate(sender, instance, signal, **kwargs):
+    if signal is post_delete and sender is PasswordHistory and not password_expiry_deferred():
+        # the expiration only depends on the latest entry
+        if PasswordHistory.objects.filter(user_id=instance.user_id, timestamp__gte=instance.timestamp).exists():
+            return
+    invalidate_password_expiry(instance.user_id)
+
+
+def connect_password_expiry_invalidate():
+    """
+    Connects password_expiry_invalidate only while password history is in
+    use, so PasswordHistory and PasswordExpiry deletes can otherwise skip
+    the per-row signals.
+    """
+    for sender in [PasswordHistory, PasswordExpiry]:
+        for signal in [post_save, post_delete]:
+            if settings.ACCOUNT_PASSWORD_USE_HISTORY:
+                signal.connect(password_expiry_invalidate, sender=sender)
+            else:
+                signal.disconnect(password_expiry_invalidate, sender=sender)
+
+
+connect_password_expiry_invalidate()
+
+
+@receiver(setting_changed)
+def password_expiry_setting_changed(setting, **kwargs):
+    if setting == "ACCOUNT_PASSWORD_USE_HISTORY":
+        connect_password_expiry_invalidate()
+
+
+class EmailOutbox(models.Model):
+    """
+    An email waiting to be delivered by the deliver_account_emails command.
+    """
+    subject = models.TextField()
+    message = models.TextField()
+    from_email = models.CharField(max_length=254)
+    to = models.JSONField(default=list)
+    created = models.DateTimeField(default=timezone.now)
+    sent = models.DateTimeField(null=True, blank=True)
+    attempts = models.PositiveIntegerField(default=0)
+    next_attempt = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True)
+    # used to claim batches while they are delivered
+    lease_token = models.CharField(max_length=32, blank=True, editable=False)
+    lease_expires = models.DateTimeField(null=True, blank=True, editable=False)
+
+    class Meta:
+        verbose_name = _("email outbox")
+        verbose_name_plural = _("email outbox")
+        indexes = [
+            models.Index(
+                fields=["next_attempt"],
+                condition=Q(sent__isnull=True),
+                name="account_outbox_due_idx",
+            ),
+        ]
+
+    def __str__(self):
+        return "{0} to {1}".format(self.subject, ", ".join(self.to))
+
+    @classmethod
+    def due(cls):
+        return cls.objects.filter(
+            sent__isnull=True,
+            attempts__lt=settings.ACCOUNT_EMAIL_OUTBOX_MAX_ATTEMPTS,
+            next_attempt__lte=timezone.now(),
+        )
+
+    @classmethod
+    def deliver(cls, batch_size=100, callback=None):
+        """
+        Delivers due emails in batches over a single mail connection and
+        returns the number sent. Failed emails are retried with exponential
+        backoff starting at ``ACCOUNT_EMAIL_OUTBOX_RETRY_DELAY`` seconds.
+        Batches are claimed so several workers can deliver at once.
+        """
+        skip_locked = connections[router.db_for_write(cls)].features.has_select_for_update_skip_locked
+        count = 0
+        connection = get_connection()
+        try:
+            while True:
+                # the lease is committed before sending so no transaction
+                # stays open while the mail server is talked to
+                batch = lease_rows(cls.due(), batch_size, settings.ACCOUNT_EMAIL_OUTBOX_LEASE, skip_locked=skip_locked)
+                if not batch:
+                    break
+                count += cls.send_batch(batch, connection)
+                if callback is not None:
+                    callback(count)
+        finally:
+            connection.close()
+        return count
+
+    @classmethod
+    def send_batch(cls, batch, connection):
+        delivered = []
+        for email in batch:
+            message = EmailMessage(email.subject, email.message, email.from_email, email.to, connection=connection)
+            try:
+                connection.send_messages([message])
+            except Exception as e:
+                # the connection may be unusable; it is reopened on next send
+                connection.close()
+                email.attempts += 1
+                delay = settings.ACCOUNT_EMAIL_OUTBOX_RETRY_DELAY * 2 ** (email.attempts - 1)
+                email.next_attempt = timezone.now() + datetime.timedelta(seconds=delay)
+                email.last_error = str(e)
+                email.lease_token = ""
+                email.lease_expires = None
+                email.save(update_fields=["attempts", "next_attempt", "last_error", "lease_token", "lease_expires"])
+            else:
+                delivered.append(email.pk)
+        cls.objects.filter(pk__in=delivered).update(
+            sent=timezone.now(),
+            attempts=F("attempts") + 1,
+            lease_token="",
+            lease_expires=None,
+        )
+        return len(delivered)
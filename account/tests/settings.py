@@ -1,3 +1,6 @@
+import os
+import tempfile
+
 DEBUG = True
 USE_TZ = True
 INSTALLED_APPS = [
@@ -13,7 +16,15 @@ DATABASES = {
     "default": {
         "ENGINE": "django.db.backends.sqlite3",
         "NAME": ":memory:",
-    }
+    },
+    # file-backed database for tests that hit it from several threads
+    "concurrency": {
+        "ENGINE": "django.db.backends.sqlite3",
+        "NAME": os.path.join(tempfile.gettempdir(), "account-concurrency.sqlite3"),
+        "TEST": {
+            "NAME": os.path.join(tempfile.gettempdir(), "account-test-concurrency.sqlite3"),
+        },
+    },
 }
 SITE_ID = 1
 ROOT_URLCONF = "account.tests.urls"
@@ -1,6 +1,17 @@
+import datetime
+import time
+from unittest import mock
+
 from django.contrib.auth import authenticate
 from django.contrib.auth.models import User
+from django.core.cache import cache
 from django.test import TestCase, override_settings
+from django.utils import timezone
+
+from account.auth_backends import AccountModelBackend
+from account.cache import user_cache
+from account.models import PasswordExpiry, PasswordHistory
+from account.utils import check_password_expired
 
 
 @override_settings(
@@ -79,3 +90,108 @@ class EmailAuthenticationBackendTestCase(TestCase):
         request = None
         authed_user = authenticate(request, username="user-does-not-exist", password="password")
         self.assertTrue(authed_user is None)
+
+
+@override_settings(
+    ACCOUNT_USER_CACHE=True,
+    CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}},
+)
+class CachedAccountModelBackendTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        user_cache.clear()
+        user_cache.reset_stats()
+        self.backend = AccountModelBackend()
+        self.user = User.objects.create_user("user1", email="user1@example.com", password="password")
+
+    def test_cached_user(self):
+        user = self.backend.get_user(self.user.pk)
+        self.assertEqual(user.pk, self.user.pk)
+        with self.assertNumQueries(0):
+            user = self.backend.get_user(self.user.pk)
+            self.assertEqual(user.password, self.user.password)
+            self.assertEqual(user.account.timezone, self.user.account.timezone)
+        self.assertEqual(user_cache.stats()["misses"], 1)
+        self.assertEqual(user_cache.stats()["hits"], 1)
+
+    def test_shared_cache_hit(self):
+        self.backend.get_user(self.user.pk)
+        user_cache.clear()
+        with self.assertNumQueries(0):
+            user = self.backend.get_user(self.user.pk)
+        self.assertEqual(user.username, "user1")
+        self.assertEqual(user_cache.stats()["shared_hits"], 1)
+
+    def test_missing_account_is_cached(self):
+        self.user.account.delete()
+        self.backend.get_user(self.user.pk)
+        with self.assertNumQueries(0):
+            user = self.backend.get_user(self.user.pk)
+            self.assertFalse(hasattr(user, "account"))
+
+    def test_user_save_invalidates(self):
+        self.backend.get_user(self.user.pk)
+        self.user.is_active = False
+        self.user.save()
+        self.assertIsNone(self.backend.get_user(self.user.pk))
+
+    def test_account_save_invalidates(self):
+        self.backend.get_user(self.user.pk)
+        account = self.user.account
+        account.language = "nl"
+        account.save()
+        self.assertEqual(self.backend.get_user(self.user.pk).account.language, "nl")
+
+    def test_user_delete_invalidates(self):
+        pk = self.user.pk
+        self.backend.get_user(pk)
+        self.user.delete()
+        self.assertIsNone(self.backend.get_user(pk))
+
+    def test_snapshot_expires(self):
+        self.backend.get_user(self.user.pk)
+        User.objects.filter(pk=self.user.pk).update(first_name="updated")
+        self.assertEqual(self.backend.get_user(self.user.pk).first_name, "")
+        loaded = time.time()
+        with mock.patch("account.cache.time.time", return_value=loaded + 301):
+            self.assertEqual(self.backend.get_user(self.user.pk).first_name, "updated")
+        self.assertEqual(user_cache.stats()["misses"], 2)
+
+    def test_lru_bound(self):
+        other = User.objects.create_user("user2", password="password")
+        with self.settings(ACCOUNT_USER_CACHE_SIZE=1):
+            self.backend.get_user(self.user.pk)
+            self.backend.get_user(other.pk)
+            self.assertEqual(user_cache.stats()["size"], 1)
+
+
+@override_settings(
+    ACCOUNT_PASSWORD_USE_HISTORY=True,
+    ACCOUNT_PASSWORD_EXPIRY=60,
+)
+class AccountModelBackendPasswordExpiryTestCase(TestCase):
+
+    def setUp(self):
+        self.backend = AccountModelBackend()
+        self.user = User.objects.create_user("user1", email="user1@example.com", password="password")
+
+    def test_no_history(self):
+        user = self.backend.get_user(self.user.pk)
+        with self.assertNumQueries(0):
+            self.assertFalse(check_password_expired(user))
+
+    def test_expired(self):
+        timestamp = timezone.now() - datetime.timedelta(seconds=120)
+        PasswordHistory.objects.create(user=self.user, password="", timestamp=timestamp)
+        with self.assertNumQueries(1):
+            user = self.backend.get_user(self.user.pk)
+            self.assertTrue(check_password_expired(user))
+
+    def test_user_expiry(self):
+        timestamp = timezone.now() - datetime.timedelta(seconds=120)
+        PasswordHistory.objects.create(user=self.user, password="", timestamp=timestamp)
+        PasswordExpiry.objects.create(user=self.user, expiry=600)
+        with self.assertNumQueries(1):
+            user = self.backend.get_user(self.user.pk)
+            self.assertFalse(check_password_expired(user))
@@ -1,11 +1,46 @@
+import datetime
+import json
+import os
+import tempfile
 from io import StringIO
+from unittest import mock
 
 from django.contrib.auth import get_user_model
-from django.core.management import call_command
-from django.test import TestCase, override_settings
-
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import Group
+from django.contrib.sites.models import Site
+from django.core import mail
+from django.core.cache import cache
+from django.core.management import CommandError, call_command
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+
+from account.cache import password_expiry_version_key
 from account.conf import settings
-from account.models import PasswordExpiry, PasswordHistory
+from account.hooks import AccountDefaultHookSet, AccountOutboxHookSet, hookset
+from account.languages import DEFAULT_LANGUAGE
+from account.models import (
+    Account,
+    AccountDeletion,
+    EmailAddress,
+    EmailConfirmation,
+    EmailOutbox,
+    PasswordExpiry,
+    PasswordHistory,
+    SignupCode,
+)
+
+
+def write_file(testcase, suffix, content):
+    """
+    Writes content to a temporary file removed when the test ends and
+    returns its path.
+    """
+    fd, path = tempfile.mkstemp(suffix=suffix)
+    with os.fdopen(fd, "w") as f:
+        f.write(content)
+    testcase.addCleanup(os.remove, path)
+    return path
 
 
 @override_settings(
@@ -91,6 +126,58 @@ class UserPasswordExpiryTests(TestCase):
         )
         self.assertIn('User "{}" not found'.format(bad_username), out.getvalue())
 
+    def test_bulk_file(self):
+        """
+        Ensure password expiry is set in bulk from a file of usernames.
+        """
+        PasswordExpiry.objects.create(user=self.user, expiry=123)
+        for i in range(4):
+            self.UserModel.objects.create_user(username="user{}".format(i))
+        path = write_file(self, "", "user0\nuser1\n\nuser2\nnobody\n")
+        out = StringIO()
+        call_command("user_password_expiry", "patrick", "--file={}".format(path), "--expire=60", "--batch-size=2", stdout=out)
+        self.assertIn("Password expiration set to 60 seconds for 4 users, 1 not found", out.getvalue())
+        self.assertEqual(
+            set(PasswordExpiry.objects.filter(expiry=60).values_list("user__username", flat=True)),
+            {"patrick", "user0", "user1", "user2"},
+        )
+        self.assertEqual(PasswordExpiry.objects.count(), 4)
+
+    @override_settings(ACCOUNT_PASSWORD_USE_HISTORY=True)
+    def test_bulk_invalidates_expiry(self):
+        users = [self.user] + [self.UserModel.objects.create_user(username="user{}".format(i)) for i in range(3)]
+        with mock.patch("account.management.commands.user_password_expiry.invalidate_password_expiry_many") as invalidate:
+            call_command("user_password_expiry", "--all-active", "--batch-size=2", stdout=StringIO())
+        self.assertEqual(invalidate.call_args_list, [
+            mock.call([users[0].pk, users[1].pk]),
+            mock.call([users[2].pk, users[3].pk]),
+        ])
+        with self.settings(ACCOUNT_PASSWORD_USE_HISTORY=False):
+            with mock.patch("account.management.commands.user_password_expiry.invalidate_password_expiry_many") as invalidate:
+                call_command("user_password_expiry", "--all-active", stdout=StringIO())
+        self.assertFalse(invalidate.called)
+
+    def test_no_users(self):
+        with self.assertRaises(CommandError):
+            call_command("user_password_expiry", "--expire=60", stdout=StringIO())
+
+    def test_bulk_filters(self):
+        """
+        Ensure password expiry is set in bulk for a group or all active users.
+        """
+        group = Group.objects.create(name="staff")
+        self.user.groups.add(group)
+        inactive = self.UserModel.objects.create_user(username="inactive", is_active=False)
+        inactive.groups.add(group)
+        self.UserModel.objects.create_user(username="other")
+        out = StringIO()
+        call_command("user_password_expiry", "--group=staff", "--all-active", "--expire=60", stdout=out)
+        self.assertIn("for 1 users, 0 not found", out.getvalue())
+        self.assertEqual(list(PasswordExpiry.objects.values_list("user", flat=True)), [self.user.pk])
+        call_command("user_password_expiry", "--all-active", "--batch-size=1", stdout=out)
+        self.assertIn("for 2 users, 0 not found", out.getvalue())
+        self.assertEqual(PasswordExpiry.objects.filter(expiry=settings.ACCOUNT_PASSWORD_EXPIRY).count(), 2)
+
 
 class UserPasswordHistoryTests(TestCase):
 
@@ -224,3 +311,529 @@ class UserPasswordHistoryTests(TestCase):
 
         self.assertIn("Password history set to ", out.getvalue())
         self.assertIn("for {} users".format(3), out.getvalue())
+
+    def test_set_history_batches(self):
+        """
+        Ensure password history is created in batches and can be resumed.
+        """
+        users = [self.user] + [self.UserModel.objects.create_user(username="user{}".format(i)) for i in range(4)]
+        out = StringIO()
+        call_command(
+            "user_password_history",
+            "--batch-size=2",
+            "--start-pk={}".format(users[1].pk),
+            stdout=out
+        )
+        self.assertIn("2 users done, up to pk {}".format(users[3].pk), out.getvalue())
+        self.assertIn("for {} users".format(3), out.getvalue())
+        self.assertEqual(
+            set(PasswordHistory.objects.values_list("user", flat=True)),
+            {user.pk for user in users[2:]},
+        )
+
+    @override_settings(ACCOUNT_PASSWORD_USE_HISTORY=True)
+    def test_set_history_invalidates_expiry(self):
+        """
+        Ensure existing password expiry counters are bumped once per batch.
+        """
+        other = self.UserModel.objects.create_user(username="james")
+        cache.clear()
+        key = password_expiry_version_key(self.user.pk)
+        cache.set(key, 1)
+        with mock.patch.object(cache, "get_many", wraps=cache.get_many) as get_many:
+            call_command("user_password_history", "--batch-size=2", stdout=StringIO())
+        self.assertEqual(get_many.call_count, 1)
+        self.assertEqual(cache.get(key), 2)
+        self.assertIsNone(cache.get(password_expiry_version_key(other.pk)))
+
+    def test_set_history_without_history(self):
+        """
+        Ensure no counters are touched when password history is not used.
+        """
+        with mock.patch("account.management.commands.user_password_history.invalidate_password_expiry_many") as invalidate:
+            call_command("user_password_history", stdout=StringIO())
+        self.assertFalse(invalidate.called)
+
+
+class ExpungeDeletedTests(TestCase):
+
+    def setUp(self):
+        self.UserModel = get_user_model()
+        requested = timezone.now() - datetime.timedelta(hours=settings.ACCOUNT_DELETION_EXPUNGE_HOURS + 1)
+        for i in range(5):
+            user = self.UserModel.objects.create_user(username="user{}".format(i))
+            AccountDeletion.mark(user)
+        AccountDeletion.objects.update(date_requested=requested)
+        self.keep = self.UserModel.objects.create_user(username="recent")
+        AccountDeletion.mark(self.keep)
+
+    def test_expunge(self):
+        out = StringIO()
+        call_command("expunge_deleted", stdout=out)
+        self.assertIn("5 expunged.", out.getvalue())
+        self.assertEqual(list(self.UserModel.objects.all()), [self.keep])
+
+    def test_expunge_batches(self):
+        out = StringIO()
+        call_command("expunge_deleted", "--batch-size=2", stdout=out)
+        output = out.getvalue()
+        self.assertIn("2 expunged (", output)
+        self.assertIn("4 expunged (", output)
+        self.assertIn("5 expunged.", output)
+        self.assertEqual(list(self.UserModel.objects.all()), [self.keep])
+        self.assertEqual(AccountDeletion.objects.filter(date_expunged__isnull=False).count(), 5)
+        self.assertEqual(AccountDeletion.objects.filter(user__isnull=False).count(), 1)
+
+    @override_settings(ACCOUNT_DELETION_EXPUNGE_RELATED_BATCH_SIZE=2)
+    def test_expunge_related_in_batches(self):
+        user = self.UserModel.objects.get(username="user0")
+        for _ in range(5):
+            PasswordHistory.objects.create(user=user)
+        EmailAddress.objects.create(user=user, email="user0@example.com")
+        call_command("expunge_deleted", stdout=StringIO())
+        self.assertFalse(PasswordHistory.objects.exists())
+        self.assertFalse(EmailAddress.objects.exists())
+        self.assertEqual(list(self.UserModel.objects.all()), [self.keep])
+
+    @override_settings(
+        ACCOUNT_DELETION_EXPUNGE_RELATED_BATCH_SIZE=2,
+        ACCOUNT_DELETION_EXPUNGE_RELATED_MODELS=["account.PasswordExpiry"],
+    )
+    def test_expunge_related_models(self):
+        user = self.UserModel.objects.get(username="user0")
+        PasswordExpiry.objects.create(user=user)
+        call_command("expunge_deleted", "--batch-size=3", stdout=StringIO())
+        self.assertFalse(PasswordExpiry.objects.exists())
+        self.assertEqual(list(self.UserModel.objects.all()), [self.keep])
+
+    def test_expunge_worker(self):
+        out = StringIO()
+        call_command("expunge_deleted", "--worker", "--batch-size=2", stdout=out)
+        self.assertIn("5 expunged.", out.getvalue())
+        self.assertEqual(list(self.UserModel.objects.all()), [self.keep])
+        self.assertFalse(AccountDeletion.objects.exclude(lease_token="").exists())
+
+    def test_expunge_batches_custom_hook(self):
+        class HookSet(AccountDefaultHookSet):
+            def account_delete_expunge(self, deletion):
+                expunged.append(deletion.pk)
+                super().account_delete_expunge(deletion)
+
+        expunged = []
+        with override_settings(ACCOUNT_HOOKSET=HookSet()):
+            call_command("expunge_deleted", "--worker", stdout=StringIO())
+        self.assertEqual(len(expunged), 5)
+        self.assertEqual(list(self.UserModel.objects.all()), [self.keep])
+
+    def test_expunge_batches_atomic(self):
+        class HookSet(AccountDefaultHookSet):
+            def account_delete_expunge_many(self, deletions):
+                super().account_delete_expunge_many(deletions)
+                raise RuntimeError()
+
+        with override_settings(ACCOUNT_HOOKSET=HookSet()):
+            with self.assertRaises(RuntimeError):
+                call_command("expunge_deleted", "--worker", stdout=StringIO())
+        self.assertEqual(self.UserModel.objects.count(), 6)
+        self.assertFalse(AccountDeletion.objects.filter(date_expunged__isnull=False).exists())
+
+    def test_lease_skips_claimed(self):
+        pending = AccountDeletion.objects.filter(user__isnull=False).exclude(user=self.keep)
+        first = AccountDeletion.lease(pending, 3)
+        second = AccountDeletion.lease(pending, 3)
+        self.assertEqual(len(first), 3)
+        self.assertEqual(len(second), 2)
+        self.assertFalse({d.pk for d in first} & {d.pk for d in second})
+
+
+@override_settings(DATABASE_ROUTERS=["account.tests.test_models.ConcurrencyRouter"])
+class ExpungeDeletedWorkersTests(TransactionTestCase):
+
+    databases = {"default", "concurrency"}
+
+    def test_workers(self):
+        UserModel = get_user_model()
+        for i in range(20):
+            AccountDeletion.mark(UserModel.objects.create_user(username="user{}".format(i)))
+        AccountDeletion.objects.update(date_requested=timezone.now() - datetime.timedelta(days=30))
+        out = StringIO()
+        call_command("expunge_deleted", "--workers=3", "--batch-size=2", stdout=out)
+        self.assertIn("20 expunged.", out.getvalue())
+        self.assertFalse(UserModel.objects.exists())
+        self.assertEqual(AccountDeletion.objects.filter(date_expunged__isnull=False).count(), 20)
+
+
+class PurgeEmailConfirmationsTests(TestCase):
+
+    def setUp(self):
+        user = get_user_model().objects.create_user(username="patrick")
+        self.email_address = EmailAddress.objects.create(user=user, email="patrick@example.com")
+        old = timezone.now() - datetime.timedelta(days=settings.ACCOUNT_EMAIL_CONFIRMATION_EXPIRE_DAYS + 1)
+        for i in range(3):
+            self.create_confirmation("expired{}".format(i), sent=old)
+        self.create_confirmation("unsent", created=old)
+        self.fresh = self.create_confirmation("fresh", sent=timezone.now())
+        self.fresh_unsent = self.create_confirmation("fresh_unsent")
+
+    def create_confirmation(self, key, **kwargs):
+        return EmailConfirmation.objects.create(email_address=self.email_address, key=key, **kwargs)
+
+    def test_dry_run(self):
+        out = StringIO()
+        call_command("purge_email_confirmations", "--dry-run", stdout=out)
+        self.assertIn("4 expired email confirmations would be deleted.", out.getvalue())
+        self.assertEqual(EmailConfirmation.objects.count(), 6)
+
+    def test_purge(self):
+        out = StringIO()
+        call_command("purge_email_confirmations", "--batch-size=2", stdout=out)
+        self.assertIn("4 expired email confirmations deleted.", out.getvalue())
+        self.assertEqual(set(EmailConfirmation.objects.all()), {self.fresh, self.fresh_unsent})
+
+
+@override_settings(ACCOUNT_HOOKSET=AccountOutboxHookSet())
+class DeliverAccountEmailsTests(TestCase):
+
+    def setUp(self):
+        for i in range(5):
+            hookset.send_email("Subject {}".format(i), "Message", ["user{}@example.com".format(i)])
+
+    def test_outbox_hookset(self):
+        self.assertEqual(len(mail.outbox), 0)
+        self.assertEqual(EmailOutbox.objects.filter(sent__isnull=True).count(), 5)
+        self.assertEqual(EmailOutbox.objects.get(subject="Subject 0").to, ["user0@example.com"])
+
+    def test_deliver(self):
+        out = StringIO()
+        with mock.patch("account.models.get_connection", wraps=mail.get_connection) as get_connection:
+            call_command("deliver_account_emails", "--batch-size=2", stdout=out)
+        self.assertEqual(get_connection.call_count, 1)
+        output = out.getvalue()
+        self.assertIn("4 emails sent so far", output)
+        self.assertIn("5 emails sent.", output)
+        self.assertEqual(sorted(m.subject for m in mail.outbox), ["Subject {}".format(i) for i in range(5)])
+        self.assertFalse(EmailOutbox.objects.filter(sent__isnull=True).exists())
+        call_command("deliver_account_emails", stdout=out)
+        self.assertEqual(len(mail.outbox), 5)
+
+    def test_retry_with_backoff(self):
+        send_messages = mail.get_connection().send_messages
+
+        def flaky(messages):
+            if messages[0].subject == "Subject 0":
+                raise OSError("connection refused")
+            return send_messages(messages)
+
+        with mock.patch("django.core.mail.backends.locmem.EmailBackend.send_messages", side_effect=flaky):
+            self.assertEqual(EmailOutbox.deliver(), 4)
+        failed = EmailOutbox.objects.get(subject="Subject 0")
+        self.assertEqual(failed.attempts, 1)
+        self.assertEqual(failed.last_error, "connection refused")
+        self.assertIsNone(failed.sent)
+        self.assertGreater(failed.next_attempt, timezone.now())
+        self.assertEqual(EmailOutbox.deliver(), 0)
+
+        EmailOutbox.objects.filter(pk=failed.pk).update(next_attempt=timezone.now())
+        self.assertEqual(EmailOutbox.deliver(), 1)
+        failed.refresh_from_db()
+        self.assertEqual(failed.attempts, 2)
+        self.assertIsNotNone(failed.sent)
+
+    @override_settings(ACCOUNT_EMAIL_OUTBOX_MAX_ATTEMPTS=1)
+    def test_max_attempts(self):
+        with mock.patch("django.core.mail.backends.locmem.EmailBackend.send_messages", side_effect=OSError):
+            self.assertEqual(EmailOutbox.deliver(), 0)
+        EmailOutbox.objects.update(next_attempt=timezone.now())
+        self.assertEqual(EmailOutbox.deliver(), 0)
+        self.assertEqual(len(mail.outbox), 0)
+
+
+class SendInvitationsTests(TestCase):
+
+    def setUp(self):
+        signup_code = SignupCode.create(email="existing@example.com", check_exists=False)
+        signup_code.sent = timezone.now()
+        signup_code.save()
+
+    def test_csv(self):
+        emails = ["user{}@example.com".format(i) for i in range(5)] + ["existing@example.com", "user0@example.com"]
+        path = write_file(self, ".csv", "name,email\n" + "".join("x,{}\n".format(e) for e in emails))
+        out = StringIO()
+        with mock.patch("account.hooks.get_connection", wraps=mail.get_connection) as get_connection:
+            with self.captureOnCommitCallbacks(execute=True):
+                call_command("send_invitations", path, "--batch-size=2", stdout=out)
+        output = out.getvalue()
+        self.assertIn("2 sent, 0 skipped", output)
+        self.assertIn("5 invitations sent, 2 skipped.", output)
+        self.assertEqual(get_connection.call_count, 3)
+        self.assertEqual(sorted(m.to[0] for m in mail.outbox), emails[:5])
+        self.assertEqual(SignupCode.objects.filter(sent__isnull=False, max_uses=1).count(), 5)
+        self.assertEqual(SignupCode.objects.count(), 6)
+
+    def test_jsonl(self):
+        lines = [{"email": "user{}@example.com".format(i)} for i in range(3)] + ["plain@example.com"]
+        path = write_file(self, ".jsonl", "\n".join(json.dumps(line) for line in lines))
+        out = StringIO()
+        call_command("send_invitations", path, stdout=out)
+        self.assertIn("4 invitations sent, 0 skipped.", out.getvalue())
+        self.assertTrue(SignupCode.objects.filter(email="plain@example.com").exists())
+
+    def test_bulk_invite_queries(self):
+        emails = ("user{}@example.com".format(i) for i in range(100))
+        site = Site.objects.get_current()
+        # per chunk: existing codes, insert, update
+        with self.assertNumQueries(4 * 3):
+            sent, skipped = SignupCode.objects.bulk_invite(emails, batch_size=25, site=site)
+        self.assertEqual((sent, skipped), (100, 0))
+
+    def test_bulk_invite_resends_unsent(self):
+        unsent = SignupCode.create(email="unsent@example.com", check_exists=False)
+        unsent.save()
+        expired = SignupCode.create(email="expired@example.com", check_exists=False, expiry=-1)
+        expired.save()
+        with self.captureOnCommitCallbacks(execute=True):
+            sent, skipped = SignupCode.objects.bulk_invite(["unsent@example.com", "expired@example.com"])
+        self.assertEqual((sent, skipped), (2, 0))
+        self.assertEqual(SignupCode.objects.filter(email="unsent@example.com").get().code, unsent.code)
+        self.assertEqual(SignupCode.objects.filter(email="expired@example.com", sent__isnull=False).count(), 1)
+        self.assertIn(unsent.code, mail.outbox[0].body)
+
+    def test_bad_inviter(self):
+        path = write_file(self, ".csv", "email\n")
+        with self.assertRaises(CommandError):
+            call_command("send_invitations", path, "--inviter=nobody")
+
+
+class ImportAccountsTests(TestCase):
+
+    def test_csv(self):
+        hashed = make_password("secret")
+        rows = ["user{0},user{0}@example.com,{1}".format(i, hashed) for i in range(5)]
+        path = write_file(self, ".csv", "username,email,password_hash\n" + "\n".join(rows) + "\n")
+        out = StringIO()
+        call_command("import_accounts", path, "--batch-size=2", "--password-history", stdout=out)
+        output = out.getvalue()
+        self.assertIn("2 imported (", output)
+        self.assertIn("5 users imported.", output)
+        UserModel = get_user_model()
+        user = UserModel.objects.get(username="user3")
+        self.assertTrue(user.check_password("secret"))
+        self.assertEqual(user.account.language, DEFAULT_LANGUAGE)
+        self.assertEqual(EmailAddress.objects.get(user=user, primary=True).email, "user3@example.com")
+        self.assertEqual(Account.objects.count(), 5)
+        self.assertEqual(PasswordHistory.objects.filter(password=hashed).count(), 5)
+
+    def test_jsonl(self):
+        lines = [
+            {"username": "plain", "email": "plain@example.com", "password": "secret", "first_name": "Plain"},
+            {"username": "nopassword"},
+        ]
+        path = write_file(self, ".jsonl", "\n".join(json.dumps(line) for line in lines))
+        call_command("import_accounts", path, "--verified", stdout=StringIO())
+        UserModel = get_user_model()
+        self.assertTrue(UserModel.objects.get(username="plain").check_password("secret"))
+        self.assertFalse(UserModel.objects.get(username="nopassword").has_usable_password())
+        self.assertTrue(EmailAddress.objects.get(email="plain@example.com").verified)
+        self.assertEqual(EmailAddress.objects.count(), 1)
+        self.assertFalse(PasswordHistory.objects.exists())
+
+    def test_csv_booleans(self):
+        path = write_file(self, ".csv", "username,is_staff,is_active\nstaff,true,1\ninactive,False,0\ndefault,,\n")
+        call_command("import_accounts", path, stdout=StringIO())
+        UserModel = get_user_model()
+        self.assertEqual(
+            list(UserModel.objects.order_by("username").values_list("username", "is_staff", "is_active")),
+            [("default", False, True), ("inactive", False, False), ("staff", True, True)],
+        )
+
+    def test_unknown_field(self):
+        path = write_file(self, ".csv", "username,nickname\nuser0,zero\n")
+        with self.assertRaisesMessage(CommandError, "Unknown user fields: nickname"):
+            call_command("import_accounts", path, stdout=StringIO())
+        self.assertFalse(get_user_model().objects.exists())
+
+    def test_duplicate_username_resume(self):
+        get_user_model().objects.create_user("user3")
+        rows = "".join("user{0},user{0}@example.com\n".format(i) for i in range(6))
+        path = write_file(self, ".csv", "username,email\n" + rows)
+        with self.assertRaisesMessage(CommandError, "2 rows were imported before the batch that failed"):
+            call_command("import_accounts", path, "--batch-size=2", stdout=StringIO())
+        self.assertEqual(
+            list(get_user_model().objects.order_by("username").values_list("username", flat=True)),
+            ["user0", "user1", "user3"],
+        )
+        get_user_model().objects.filter(username="user3").delete()
+        call_command("import_accounts", path, "--skip=2", stdout=StringIO())
+        self.assertEqual(
+            list(Account.objects.order_by("user__username").values_list("user__username", flat=True)),
+            ["user{}".format(i) for i in range(6)],
+        )
+
+    def test_bulk_provision_queries(self):
+        UserModel = get_user_model()
+        users = (UserModel(username="user{}".format(i), email="user{}@example.com".format(i)) for i in range(10))
+        # per chunk: savepoint, users, accounts, email addresses, release
+        with self.assertNumQueries(2 * 5):
+            self.assertEqual(Account.objects.bulk_provision(users, batch_size=5), 10)
+        self.assertEqual(EmailAddress.objects.filter(primary=True).count(), 10)
+
+
+class EnsureAccountsTests(TestCase):
+
+    def setUp(self):
+        UserModel = get_user_model()
+        self.users = UserModel.objects.bulk_create([
+            UserModel(username="user{}".format(i), email="user{}@example.com".format(i) if i % 4 else "")
+            for i in range(8)
+        ])
+        self.complete = UserModel.objects.create_user("complete", email="complete@example.com")
+        self.promote = UserModel.objects.bulk_create([UserModel(username="promote", email="promote@example.com")])[0]
+        EmailAddress.objects.create(user=self.promote, email="promote@example.com")
+        self.taken = UserModel.objects.bulk_create([UserModel(username="taken", email="complete@example.com")])[0]
+
+    def test_ensure_accounts(self):
+        out = StringIO()
+        call_command("ensure_accounts", "--batch-size=3", stdout=out)
+        self.assertIn("10 accounts and 6 email addresses created.", out.getvalue())
+        self.assertEqual(Account.objects.count(), 11)
+        self.assertEqual(EmailAddress.objects.filter(primary=True).count(), 8)
+        self.assertTrue(EmailAddress.objects.get(user=self.promote).primary)
+        self.assertFalse(EmailAddress.objects.filter(user=self.taken).exists())
+        self.assertFalse(EmailAddress.objects.filter(email="").exists())
+
+    def test_pk_range(self):
+        out = StringIO()
+        call_command(
+            "ensure_accounts",
+            "--start-pk={}".format(self.users[1].pk),
+            "--end-pk={}".format(self.users[4].pk),
+            "--no-emails",
+            stdout=out,
+        )
+        self.assertIn("3 accounts and 0 email addresses created.", out.getvalue())
+        self.assertEqual(
+            set(Account.objects.exclude(user=self.complete).values_list("user", flat=True)),
+            {user.pk for user in self.users[2:5]},
+        )
+
+    def test_conflicting_emails_not_counted(self):
+        UserModel = get_user_model()
+        UserModel.objects.bulk_create([
+            UserModel(username="twin{}".format(i), email="twin@example.com") for i in range(2)
+        ])
+        # both users miss an address but only one insert can succeed
+        accounts, emails = Account.objects.ensure_accounts()
+        self.assertEqual((accounts, emails), (12, 7))
+        self.assertEqual(EmailAddress.objects.filter(email="twin@example.com").count(), 1)
+
+    def test_queries_per_batch(self):
+        # per batch: pks, savepoint, missing accounts, insert, count,
+        # promote, missing email addresses, insert, count, release; then
+        # the final pks
+        with self.assertNumQueries(2 * 10 + 1):
+            Account.objects.ensure_accounts(batch_size=6)
+
+
+@override_settings(ACCOUNT_PASSWORD_USE_HISTORY=True, ACCOUNT_PASSWORD_EXPIRY=86400)
+class PasswordExpiryReportTests(TestCase):
+
+    def setUp(self):
+        UserModel = get_user_model()
+        now = timezone.now()
+        self.users = {}
+        for name, days_ago in [("soon", 0.5), ("later", -10), ("expired", 3), ("fresh", -0.5)]:
+            user = UserModel.objects.create_user(name, email="{}@example.com".format(name))
+            PasswordExpiry.objects.create(user=user, expiry=86400 * 2)
+            PasswordHistory.objects.create(user=user, timestamp=now - datetime.timedelta(days=1 + days_ago))
+            self.users[name] = user
+        nl = self.users["fresh"].account
+        nl.language = "nl"
+        nl.save()
+
+    def test_report(self):
+        out = StringIO()
+        call_command("password_expiry_report", "--days=1", stdout=out)
+        lines = out.getvalue().splitlines()
+        self.assertEqual(lines[0], "id,username,email,password_changed,password_expiration")
+        self.assertEqual([line.split(",")[1] for line in lines[1:]], ["soon"])
+        self.assertEqual(len(mail.outbox), 0)
+
+    @override_settings(ACCOUNT_PASSWORD_USE_HISTORY=False)
+    def test_without_history(self):
+        with self.assertRaises(CommandError):
+            call_command("password_expiry_report", "--send-warnings", stdout=StringIO())
+        self.assertEqual(len(mail.outbox), 0)
+
+    def test_include_expired(self):
+        out = StringIO()
+        call_command("password_expiry_report", "--days=1", "--include-expired", stdout=out)
+        self.assertEqual([line.split(",")[1] for line in out.getvalue().splitlines()[1:]], ["expired", "soon"])
+
+    def test_send_warnings(self):
+        out, err = StringIO(), StringIO()
+        with mock.patch("account.hooks.get_connection", wraps=mail.get_connection) as get_connection:
+            with self.captureOnCommitCallbacks(execute=True):
+                call_command(
+                    "password_expiry_report", "--days=2", "--send-warnings", "--batch-size=5",
+                    stdout=out, stderr=err,
+                )
+        self.assertIn("2 password expiry warnings sent.", err.getvalue())
+        self.assertEqual(get_connection.call_count, 1)
+        self.assertEqual(sorted(m.to[0] for m in mail.outbox), ["fresh@example.com", "soon@example.com"])
+        self.assertEqual(mail.outbox[0].subject, "Your password expires soon")
+        self.assertIn("/password/", mail.outbox[0].body)
+
+
+class PrunePasswordHistoryTests(TestCase):
+
+    def setUp(self):
+        UserModel = get_user_model()
+        now = timezone.now()
+        self.first = UserModel.objects.create_user(username="first")
+        self.second = UserModel.objects.create_user(username="second")
+        for days in range(5):
+            PasswordHistory.objects.create(user=self.first, timestamp=now - datetime.timedelta(days=days * 10))
+        # entries with the same timestamp are ordered by pk
+        self.tied = [PasswordHistory.objects.create(user=self.second, timestamp=now - datetime.timedelta(days=100))
+                     for _ in range(2)]
+
+    def timestamps(self, user):
+        now = timezone.now()
+        return sorted((now - h.timestamp).days for h in PasswordHistory.objects.filter(user=user))
+
+    def test_no_policy(self):
+        out = StringIO()
+        call_command("prune_password_history", stdout=out)
+        self.assertIn("No password history retention policy set.", out.getvalue())
+        self.assertEqual(PasswordHistory.objects.count(), 7)
+
+    def test_keep(self):
+        out = StringIO()
+        call_command("prune_password_history", "--keep=2", "--batch-size=1", stdout=out)
+        output = out.getvalue()
+        self.assertIn("1 deleted so far", output)
+        self.assertIn("3 password history entries deleted, 4 remaining", output)
+        self.assertEqual(self.timestamps(self.first), [0, 10])
+        self.assertEqual(PasswordHistory.objects.filter(user=self.second).count(), 2)
+
+    def test_keep_days(self):
+        out = StringIO()
+        call_command("prune_password_history", "--keep-days=15", stdout=out)
+        self.assertIn("4 password history entries deleted, 3 remaining", out.getvalue())
+        self.assertEqual(self.timestamps(self.first), [0, 10])
+        # the latest entry of every user is always kept
+        self.assertEqual(list(PasswordHistory.objects.filter(user=self.second)), [self.tied[1]])
+
+    @override_settings(ACCOUNT_PASSWORD_HISTORY_KEEP=3, ACCOUNT_PASSWORD_HISTORY_KEEP_DAYS=35)
+    def test_keep_and_keep_days(self):
+        self.assertEqual(PasswordHistory.objects.surplus(keep=3, keep_days=35).count(), 1)
+        out = StringIO()
+        call_command("prune_password_history", stdout=out)
+        self.assertIn("1 password history entries deleted, 6 remaining", out.getvalue())
+        self.assertEqual(self.timestamps(self.first), [0, 10, 20, 30])
+
+    def test_dry_run(self):
+        out = StringIO()
+        call_command("prune_password_history", "--keep=1", "--dry-run", stdout=out)
+        self.assertIn("5 password history entries would be deleted.", out.getvalue())
+        self.assertEqual(PasswordHistory.objects.count(), 7)
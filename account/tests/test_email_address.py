@@ -1,8 +1,15 @@
+import datetime
+
 from django.contrib.auth.models import User
+from django.core import mail
+from django.db import transaction
 from django.forms import ValidationError
-from django.test import TestCase, override_settings
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
 
-from account.models import EmailAddress
+from account.conf import settings
+from account.hooks import hookset
+from account.models import EmailAddress, EmailConfirmation
 
 
 @override_settings(ACCOUNT_EMAIL_UNIQUE=True)
@@ -23,3 +30,88 @@ class UniqueEmailAddressTestCase(TestCase):
             validation_error = True
 
         self.assertTrue(validation_error)
+
+
+class SendConfirmationTestCase(TestCase):
+
+    def setUp(self):
+        user = User.objects.create_user("user1", email="user1@example.com", password="password")
+        self.email_address = EmailAddress.objects.get(user=user)
+
+    def test_new_confirmation_each_time(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            first = self.email_address.send_confirmation()
+            second = self.email_address.send_confirmation()
+        self.assertNotEqual(first.key, second.key)
+        self.assertEqual(EmailConfirmation.objects.count(), 2)
+        self.assertEqual(len(mail.outbox), 2)
+
+    @override_settings(ACCOUNT_EMAIL_CONFIRMATION_REUSE=True)
+    def test_reuse(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            first = self.email_address.send_confirmation()
+            second = self.email_address.send_confirmation()
+        self.assertEqual(first.pk, second.pk)
+        self.assertEqual(EmailConfirmation.objects.count(), 1)
+        self.assertEqual(len(mail.outbox), 2)
+
+    @override_settings(ACCOUNT_EMAIL_CONFIRMATION_REUSE=True)
+    def test_reuse_expired(self):
+        first = self.email_address.send_confirmation()
+        first.sent = timezone.now() - datetime.timedelta(days=settings.ACCOUNT_EMAIL_CONFIRMATION_EXPIRE_DAYS + 1)
+        first.save()
+        second = self.email_address.send_confirmation()
+        self.assertNotEqual(first.pk, second.pk)
+
+    @override_settings(ACCOUNT_EMAIL_CONFIRMATION_RESEND_INTERVAL=60)
+    def test_resend_interval(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            first = self.email_address.send_confirmation()
+        with self.assertNumQueries(1), self.captureOnCommitCallbacks(execute=True):
+            second = self.email_address.send_confirmation()
+        self.assertEqual(first.pk, second.pk)
+        self.assertEqual(len(mail.outbox), 1)
+
+        first.sent = timezone.now() - datetime.timedelta(seconds=61)
+        first.save()
+        with self.captureOnCommitCallbacks(execute=True):
+            third = self.email_address.send_confirmation()
+        self.assertNotEqual(first.pk, third.pk)
+        self.assertEqual(len(mail.outbox), 2)
+
+    @override_settings(ACCOUNT_EMAIL_CONFIRMATION_REUSE=True, ACCOUNT_EMAIL_CONFIRMATION_RESEND_INTERVAL=60)
+    def test_change_sends_new_confirmation(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            first = self.email_address.send_confirmation()
+            self.email_address.change("user2@example.com")
+        self.assertFalse(EmailConfirmation.objects.filter(pk=first.pk).exists())
+        self.assertEqual(EmailConfirmation.objects.get().email_address.email, "user2@example.com")
+        self.assertEqual(len(mail.outbox), 2)
+        self.assertEqual(mail.outbox[1].to, ["user2@example.com"])
+
+
+class DeferredEmailTestCase(TransactionTestCase):
+
+    def setUp(self):
+        user = User.objects.create_user("user1", email="user1@example.com", password="password")
+        self.email_address = EmailAddress.objects.get(user=user)
+
+    def test_sent_on_commit(self):
+        with transaction.atomic():
+            self.email_address.change("user2@example.com")
+            self.assertEqual(len(mail.outbox), 0)
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].to, ["user2@example.com"])
+
+    def test_not_sent_on_rollback(self):
+        with self.assertRaises(RuntimeError):
+            with transaction.atomic():
+                self.email_address.change("user2@example.com")
+                hookset.send_password_change_email(["user1@example.com"], {"user": self.email_address.user})
+                raise RuntimeError
+        self.assertEqual(len(mail.outbox), 0)
+        self.assertFalse(EmailConfirmation.objects.exists())
+
+    def test_sent_immediately_outside_transaction(self):
+        hookset.send_password_change_email(["user1@example.com"], {"user": self.email_address.user})
+        self.assertEqual(len(mail.outbox), 1)
@@ -0,0 +1,86 @@
+from unittest import skipUnless
+
+from django.contrib.auth.models import User
+from django.db import IntegrityError, connection, transaction
+from django.db.models import Q
+from django.test import TestCase
+from django.utils import timezone
+
+from account.models import (
+    AccountDeletion,
+    EmailAddress,
+    EmailConfirmation,
+    PasswordHistory,
+    SignupCode,
+)
+from account.utils import iexact
+
+
+def query_plan(qs):
+    sql, params = qs.query.sql_with_params()
+    with connection.cursor() as cursor:
+        cursor.execute("EXPLAIN QUERY PLAN {0}".format(sql), params)
+        return " ".join(str(row[-1]) for row in cursor.fetchall())
+
+
+@skipUnless(connection.vendor == "sqlite", "query plans are checked on SQLite")
+class CaseInsensitiveLookupIndexTestCase(TestCase):
+
+    def test_email_lookup_uses_index(self):
+        qs = iexact(EmailAddress.objects.all(), "email", "User1@Example.com")
+        self.assertIn("account_email_lower_idx", query_plan(qs))
+
+    def test_username_lookup_uses_index(self):
+        # the index is created outside the migration state, so this only
+        # holds on a freshly migrated schema like the test database. On
+        # SQLite a later AlterField on the user model drops it.
+        qs = iexact(User.objects.all(), "username", "User1")
+        self.assertIn("account_username_lower_idx", query_plan(qs))
+
+    def test_lookup_is_case_insensitive(self):
+        user = User.objects.create_user("User1", email="User1@Example.com")
+        self.assertEqual(iexact(User.objects.all(), "username", "user1").get(), user)
+        self.assertEqual(iexact(EmailAddress.objects.all(), "email", "USER1@example.COM").get().user, user)
+
+
+@skipUnless(connection.vendor == "sqlite", "query plans are checked on SQLite")
+class LookupIndexTestCase(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user("user1", email="user1@example.com")
+
+    def test_pending_deletions(self):
+        qs = AccountDeletion.objects.filter(date_requested__lt=timezone.now(), user__isnull=False)
+        self.assertIn("account_deletion_pending_idx", query_plan(qs))
+
+    def test_latest_password_history(self):
+        qs = PasswordHistory.objects.filter(user=self.user).order_by("-timestamp")[:1]
+        plan = query_plan(qs)
+        self.assertIn("account_pwhistory_latest_idx", plan)
+        self.assertNotIn("TEMP B-TREE", plan)
+
+    def test_primary_email(self):
+        qs = EmailAddress.objects.filter(user=self.user, primary=True)
+        self.assertIn("account_email_one_primary", query_plan(qs))
+
+    def test_signup_code_exists(self):
+        qs = SignupCode.objects.filter(Q(code="abc") | Q(email="user1@example.com"))
+        plan = query_plan(qs)
+        self.assertIn("account_signupcode_email_idx", plan)
+        self.assertNotIn("SCAN account_signupcode", plan)
+
+    def test_sent_confirmations(self):
+        qs = EmailConfirmation.objects.filter(sent__lt=timezone.now())
+        self.assertIn("account_confirmation_sent_idx", query_plan(qs))
+
+    def test_latest_confirmation(self):
+        email_address = EmailAddress.objects.get(user=self.user)
+        qs = EmailConfirmation.objects.filter(email_address=email_address, sent__gt=timezone.now()).order_by("-sent")
+        plan = query_plan(qs[:1])
+        self.assertIn("account_confirm_latest_idx", plan)
+        self.assertNotIn("TEMP B-TREE", plan)
+
+    def test_one_primary_email_per_user(self):
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            EmailAddress.objects.create(user=self.user, email="other@example.com", primary=True)
+        EmailAddress.objects.create(user=self.user, email="other@example.com", primary=False)
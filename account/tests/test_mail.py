@@ -0,0 +1,154 @@
+import socketserver
+import threading
+from pathlib import Path
+from unittest import mock
+
+from django.core import mail
+from django.core.mail import EmailMessage
+from django.template.loader import get_template
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils import translation
+from django.utils.autoreload import file_changed
+
+from account.hooks import AccountThreadedHookSet
+from account.mail import EmailDispatcher, EmailRenderer, renderer
+
+
+class SMTPHandler(socketserver.StreamRequestHandler):
+    """
+    Speaks just enough SMTP to accept messages from smtplib.
+    """
+
+    def reply(self, line):
+        self.wfile.write(line.encode("ascii") + b"\r\n")
+
+    def handle(self):
+        self.server.connections += 1
+        self.reply("220 localhost")
+        while True:
+            line = self.rfile.readline().decode("ascii").strip()
+            command = line[:4].upper()
+            if not line or command == "QUIT":
+                self.reply("221 bye")
+                break
+            if command == "DATA":
+                self.reply("354 go ahead")
+                data = []
+                for line in iter(self.rfile.readline, b".\r\n"):
+                    data.append(line)
+                with self.server.lock:
+                    self.server.messages.append(b"".join(data))
+            self.reply("250 ok")
+
+
+class SMTPServer(socketserver.ThreadingTCPServer):
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), SMTPHandler)
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.messages = []
+
+
+def message(i):
+    return EmailMessage("Subject {}".format(i), "Message", "from@example.com", ["user{}@example.com".format(i)])
+
+
+class EmailDispatcherTestCase(TestCase):
+
+    def setUp(self):
+        self.server = SMTPServer()
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+    def smtp_settings(self):
+        return override_settings(
+            EMAIL_BACKEND="django.core.mail.backends.smtp.EmailBackend",
+            EMAIL_HOST="127.0.0.1",
+            EMAIL_PORT=self.server.server_address[1],
+        )
+
+    def test_reuses_connections(self):
+        dispatcher = EmailDispatcher(workers=2)
+        with self.smtp_settings():
+            for i in range(20):
+                self.assertTrue(dispatcher.submit(message(i)))
+            dispatcher.shutdown()
+        self.assertEqual(len(self.server.messages), 20)
+        self.assertLessEqual(self.server.connections, 2)
+        self.assertEqual(dispatcher.stats(), {"sent": 20, "failed": 0, "dropped": 0, "queued": 0})
+
+    def test_failure_reopens_connection(self):
+        dispatcher = EmailDispatcher(workers=1)
+        with self.smtp_settings(), self.assertLogs("account.mail", "ERROR"):
+            dispatcher.submit(EmailMessage("Subject", "Message", "from@example.com", ["bad\nrecipient"]))
+            dispatcher.submit(message(1))
+            dispatcher.shutdown()
+        self.assertEqual(len(self.server.messages), 1)
+        self.assertEqual(dispatcher.failed, 1)
+        self.assertEqual(dispatcher.sent, 1)
+
+    def test_drops_when_full(self):
+        started = threading.Event()
+        release = threading.Event()
+
+        def send_messages(messages):
+            started.set()
+            release.wait(5)
+            return len(messages)
+
+        dispatcher = EmailDispatcher(workers=1, queue_size=1, block_timeout=0)
+        with mock.patch("django.core.mail.backends.locmem.EmailBackend.send_messages", side_effect=send_messages):
+            self.assertTrue(dispatcher.submit(message(1)))
+            started.wait(5)
+            self.assertTrue(dispatcher.submit(message(2)))
+            with self.assertLogs("account.mail", "WARNING"):
+                self.assertFalse(dispatcher.submit(message(3)))
+            release.set()
+            dispatcher.shutdown()
+        self.assertEqual(dispatcher.stats(), {"sent": 2, "failed": 0, "dropped": 1, "queued": 0})
+
+    def test_hookset(self):
+        hookset = AccountThreadedHookSet()
+        with self.captureOnCommitCallbacks(execute=True):
+            hookset.send_password_change_email(["user@example.com"], {"user": None})
+            self.assertEqual(hookset.dispatcher.stats()["sent"], 0)
+        hookset.dispatcher.flush()
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].to, ["user@example.com"])
+        hookset.dispatcher.shutdown()
+
+
+class EmailRendererTestCase(SimpleTestCase):
+
+    def test_templates_cached(self):
+        renderer = EmailRenderer()
+        with mock.patch("account.mail.get_template", wraps=get_template) as loader:
+            for i in range(3):
+                subject, message = renderer.render("password_reset", {"password_reset_url": str(i)})
+        self.assertEqual((subject, message), ("Hello", "2\n"))
+        self.assertEqual(loader.call_count, 2)
+
+    def test_template_change_clears_cache(self):
+        renderer.render("password_reset", {"password_reset_url": "x"})
+        self.assertTrue(renderer._templates)
+        file_changed.send(sender=None, file_path=Path("templates/account/email/password_reset.txt"))
+        self.assertFalse(renderer._templates)
+
+    def test_render_many_groups_languages(self):
+        renderer = EmailRenderer()
+        emails = [
+            (["user{}@example.com".format(i)], {"signup_url": str(i)}, ["en", "nl", None][i % 3])
+            for i in range(6)
+        ]
+        with mock.patch("account.mail.translation.override", wraps=translation.override) as override:
+            rendered = list(renderer.render_many("invite_user", emails))
+        self.assertEqual(override.call_count, 2)
+        self.assertEqual(len(rendered), 6)
+        self.assertIn((["user1@example.com"], "Invitation (nl)", "1 nl\n"), rendered)
+        self.assertIn((["user3@example.com"], "Invitation (en)", "3 en\n"), rendered)
+        self.assertIn((["user5@example.com"], "Invitation (en-us)", "5 en-us\n"), rendered)
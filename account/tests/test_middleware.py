@@ -0,0 +1,62 @@
+import copy
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.test import TestCase, modify_settings, override_settings
+from django.urls import reverse
+from django.utils import timezone, translation
+
+from account.models import Account
+
+
+def templates_with_account_context_processor():
+    templates = copy.deepcopy(settings.TEMPLATES)
+    templates[0]["OPTIONS"]["context_processors"].append("account.context_processors.account")
+    return templates
+
+
+@override_settings(TEMPLATES=templates_with_account_context_processor())
+@modify_settings(
+    MIDDLEWARE={
+        "append": "account.middleware.AccountMiddleware",
+    }
+)
+class AccountMiddlewareTestCase(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user("user1", email="user1@example.com", password="password")
+        account = self.user.account
+        account.language = "nl"
+        account.timezone = "Europe/Amsterdam"
+        account.save()
+
+    def tearDown(self):
+        timezone.deactivate()
+        translation.deactivate()
+
+    def test_activates_account_language_and_timezone(self):
+        self.client.login(username="user1", password="password")
+        response = self.client.get(reverse("account_logout"))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Content-Language"], "nl")
+        self.assertEqual(response.context["account"], self.user.account)
+        self.assertEqual(response.context["TIME_ZONE"], "Europe/Amsterdam")
+
+    def test_anonymous(self):
+        response = self.client.get(reverse("account_login"))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context["account"].user.is_authenticated, False)
+
+    def test_account_loaded_once(self):
+        self.client.login(username="user1", password="password")
+        # session, user and account; the account is shared by the
+        # middleware and the context processor.
+        with self.assertNumQueries(3):
+            self.client.get(reverse("account_logout"))
+
+    def test_missing_account(self):
+        Account.objects.filter(user=self.user).delete()
+        self.client.login(username="user1", password="password")
+        response = self.client.get(reverse("account_login"), HTTP_ACCEPT_LANGUAGE="de")
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(response["Content-Language"], "de")
@@ -1,6 +1,10 @@
-from django.test import TestCase
+import threading
 
-from account.models import SignupCode
+from django.contrib.auth.models import User
+from django.db import connections
+from django.test import TestCase, TransactionTestCase, override_settings
+
+from account.models import SignupCode, SignupCodeResult
 
 
 class SignupCodeModelTestCase(TestCase):
@@ -43,3 +47,83 @@ class SignupCodeModelTestCase(TestCase):
         code.save()
 
         self.assertTrue(SignupCode.exists(email="foobar@example.com", code="FOOFOO"))
+
+
+class SignupCodeUseTestCase(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user("user1")
+
+    def test_use(self):
+        code = SignupCode.objects.create(code="FOOFOO", max_uses=2)
+        code.use(self.user)
+        self.assertEqual(code.use_count, 1)
+        self.assertEqual(code.signupcoderesult_set.count(), 1)
+
+    def test_use_exhausted(self):
+        code = SignupCode.objects.create(code="FOOFOO", max_uses=1)
+        code.use(self.user)
+        with self.assertRaises(SignupCode.Exhausted):
+            code.use(User.objects.create_user("user2"))
+        code.refresh_from_db()
+        self.assertEqual(code.use_count, 1)
+        self.assertEqual(code.signupcoderesult_set.count(), 1)
+
+    def test_use_unlimited(self):
+        code = SignupCode.objects.create(code="FOOFOO", max_uses=0)
+        for i in range(3):
+            code.use(User.objects.create_user("user{0}".format(i + 2)))
+        self.assertEqual(code.use_count, 3)
+
+    def test_result_created_directly(self):
+        code = SignupCode.objects.create(code="FOOFOO", max_uses=2)
+        SignupCodeResult.objects.create(signup_code=code, user=self.user)
+        code.refresh_from_db()
+        self.assertEqual(code.use_count, 1)
+        code.use(User.objects.create_user("user2"))
+        code.refresh_from_db()
+        self.assertEqual(code.use_count, 2)
+
+
+class ConcurrencyRouter:
+
+    def db_for_read(self, model, **hints):
+        return "concurrency"
+
+    def db_for_write(self, model, **hints):
+        return "concurrency"
+
+
+@override_settings(DATABASE_ROUTERS=["account.tests.test_models.ConcurrencyRouter"])
+class SignupCodeConcurrentUseTestCase(TransactionTestCase):
+
+    databases = {"default", "concurrency"}
+
+    def test_no_over_redemption(self):
+        max_uses, workers = 5, 20
+        code = SignupCode.objects.create(code="FOOFOO", max_uses=max_uses)
+        users = [User.objects.create_user("user{0}".format(i)) for i in range(workers)]
+        barrier = threading.Barrier(workers)
+        outcomes = []
+
+        def redeem(user):
+            try:
+                barrier.wait()
+                SignupCode.objects.get(pk=code.pk).use(user)
+                outcomes.append(True)
+            except SignupCode.Exhausted:
+                outcomes.append(False)
+            finally:
+                connections.close_all()
+
+        threads = [threading.Thread(target=redeem, args=(user,)) for user in users]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        code.refresh_from_db()
+        self.assertEqual(outcomes.count(True), max_uses)
+        self.assertEqual(outcomes.count(False), workers - max_uses)
+        self.assertEqual(code.use_count, max_uses)
+        self.assertEqual(code.signupcoderesult_set.count(), max_uses)
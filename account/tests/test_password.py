@@ -1,15 +1,27 @@
 import datetime
+from unittest import mock
 
 import django
 from django.contrib.auth.hashers import check_password, make_password
 from django.contrib.auth.models import User
-from django.test import TestCase, modify_settings, override_settings
+from django.contrib.sessions.backends.db import SessionStore
+from django.core.cache import cache
+from django.db.models.signals import post_delete, post_save
+from django.test import RequestFactory, TestCase, modify_settings, override_settings
 from django.urls import reverse
 
 import pytz
 
+from account.cache import get_version, password_expiry_version_key
+from account.conf import settings
 from account.models import PasswordExpiry, PasswordHistory
-from account.utils import check_password_expired
+from account.utils import (
+    PASSWORD_EXPIRY_SESSION_KEY,
+    annotate_password_expiration,
+    check_password_expired,
+    check_session_password_expired,
+    get_password_expiration,
+)
 
 
 def middleware_kwarg(value):
@@ -106,6 +118,41 @@ class PasswordExpirationTestCase(TestCase):
         redirect_url = "{}?next={}".format(reverse("account_password"), url_name)
         self.assertRedirects(response, redirect_url)
 
+    def expire_password(self):
+        self.history.timestamp = (
+            datetime.datetime.now(tz=pytz.UTC) - datetime.timedelta(days=1, seconds=self.expiry.expiry)
+        )
+        self.history.save()
+
+    @override_settings(ACCOUNT_PASSWORD_EXPIRY_EXEMPT_URL_NAMES=["account_settings"])
+    def test_get_expired_exempt_url_name(self):
+        """
+        Ensure exempt URL names are not redirected when password is expired.
+        """
+        self.expire_password()
+        self.client.login(username=self.username, password=self.password)
+        response = self.client.get(reverse("account_settings"))
+        self.assertEqual(response.status_code, 200)
+
+    @override_settings(ACCOUNT_PASSWORD_EXPIRY_EXEMPT_PATHS=["/settings/"])
+    def test_get_expired_exempt_path(self):
+        """
+        Ensure exempt path prefixes are not redirected when password is expired.
+        """
+        self.expire_password()
+        self.client.login(username=self.username, password=self.password)
+        response = self.client.get(reverse("account_settings"))
+        self.assertEqual(response.status_code, 200)
+
+    def test_get_expired_unknown_path(self):
+        """
+        Ensure unknown paths fall through to a 404 when password is expired.
+        """
+        self.expire_password()
+        self.client.login(username=self.username, password=self.password)
+        response = self.client.get("/does-not-exist/")
+        self.assertEqual(response.status_code, 404)
+
     def test_password_expiration_reset(self):
         """
         Ensure changing password results in new PasswordHistory.
@@ -133,6 +180,27 @@ class PasswordExpirationTestCase(TestCase):
         self.assertTrue(latest != self.history)
         self.assertTrue(latest.timestamp > self.history.timestamp)
 
+    @override_settings(AUTHENTICATION_BACKENDS=["account.auth_backends.UsernameAuthenticationBackend"])
+    def test_expired_password_change_with_account_backend(self):
+        """
+        Ensure an expired user is let through after changing their password
+        when the backend preloads the latest password timestamp.
+        """
+        self.expire_password()
+        self.client.login(username=self.username, password=self.password)
+        response = self.client.get(reverse("account_settings"))
+        self.assertRedirects(response, "{}?next={}".format(reverse("account_password"), "account_settings"))
+
+        new_password = "lynyrdskynyrd"
+        response = self.client.post(reverse("account_password"), {
+            "password_current": self.password,
+            "password_new": new_password,
+            "password_new_confirm": new_password,
+        })
+        self.assertEqual(response.status_code, 302)
+        response = self.client.get(reverse("account_settings"))
+        self.assertEqual(response.status_code, 200)
+
 
 @modify_settings(
     **middleware_kwarg({
@@ -219,3 +287,141 @@ class ExistingUserNoHistoryTestCase(TestCase):
             )
             # history count should be zero
             self.assertEqual(self.user.password_history.count(), 0)
+
+
+@override_settings(
+    ACCOUNT_PASSWORD_USE_HISTORY=True
+)
+class SessionPasswordExpirationTestCase(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user("user1", password="changeme")
+        self.expiry = PasswordExpiry.objects.create(user=self.user, expiry=60)
+        self.history = PasswordHistory.objects.create(user=self.user, password=make_password("changeme"))
+        self.request = RequestFactory().get("/")
+        self.request.user = self.user
+        self.request.session = SessionStore()
+
+    def test_expiration_kept_in_session(self):
+        self.assertFalse(check_session_password_expired(self.request))
+        self.assertIn(PASSWORD_EXPIRY_SESSION_KEY, self.request.session)
+        with self.assertNumQueries(0):
+            self.assertFalse(check_session_password_expired(self.request))
+
+    def test_history_change_refreshes_session(self):
+        self.assertFalse(check_session_password_expired(self.request))
+        self.history.timestamp = (
+            datetime.datetime.now(tz=pytz.UTC) - datetime.timedelta(days=1, seconds=self.expiry.expiry)
+        )
+        self.history.save()
+        self.assertTrue(check_session_password_expired(self.request))
+
+    def test_expiry_change_refreshes_session(self):
+        self.assertFalse(check_session_password_expired(self.request))
+        self.expiry.expiry = 0
+        self.expiry.save()
+        self.user.refresh_from_db()
+        self.history.timestamp = (
+            datetime.datetime.now(tz=pytz.UTC) - datetime.timedelta(days=1)
+        )
+        self.history.save()
+        self.assertFalse(check_session_password_expired(self.request))
+
+    def test_missing_version_keeps_session(self):
+        self.history.save()
+        self.assertFalse(check_session_password_expired(self.request))
+        # another process with its own cache never saw the invalidation
+        cache.delete(password_expiry_version_key(self.user.pk))
+        self.request.session.modified = False
+        self.assertFalse(check_session_password_expired(self.request))
+        self.assertFalse(self.request.session.modified)
+
+    def test_missing_version_expires_session(self):
+        self.assertFalse(check_session_password_expired(self.request))
+        cache.delete(password_expiry_version_key(self.user.pk))
+        self.request.session[PASSWORD_EXPIRY_SESSION_KEY]["computed_at"] -= settings.ACCOUNT_USER_CACHE_TIMEOUT + 1
+        self.request.session.modified = False
+        self.assertFalse(check_session_password_expired(self.request))
+        self.assertTrue(self.request.session.modified)
+
+    def test_global_expiry_change_refreshes_session(self):
+        self.expiry.delete()
+        self.user.refresh_from_db()
+        self.history.timestamp = datetime.datetime.now(tz=pytz.UTC) - datetime.timedelta(days=1)
+        self.history.save()
+        with self.settings(ACCOUNT_PASSWORD_EXPIRY=0):
+            self.assertFalse(check_session_password_expired(self.request))
+        with self.settings(ACCOUNT_PASSWORD_EXPIRY=60):
+            self.assertTrue(check_session_password_expired(self.request))
+
+    def test_older_history_delete_keeps_session(self):
+        older = PasswordHistory.objects.create(
+            user=self.user,
+            password=make_password("old"),
+            timestamp=self.history.timestamp - datetime.timedelta(days=1),
+        )
+        key = password_expiry_version_key(self.user.pk)
+        version = get_version(key)
+        older.delete()
+        self.assertEqual(get_version(key), version)
+        self.history.delete()
+        self.assertNotEqual(get_version(key), version)
+
+    def test_prune_invalidates_once_per_user(self):
+        for days in range(1, 4):
+            PasswordHistory.objects.create(
+                user=self.user,
+                password=make_password("old"),
+                timestamp=self.history.timestamp - datetime.timedelta(days=days),
+            )
+        with mock.patch("account.cache.bump_version") as bump_version:
+            with self.captureOnCommitCallbacks(execute=True):
+                self.assertEqual(PasswordHistory.objects.prune(), 3)
+        self.assertEqual(bump_version.call_count, 2)  # now and on commit
+
+    @override_settings(ACCOUNT_PASSWORD_USE_HISTORY=False)
+    def test_signals_disconnected_without_history(self):
+        self.assertFalse(post_delete.has_listeners(PasswordHistory))
+        self.assertFalse(post_save.has_listeners(PasswordExpiry))
+
+    def test_login_stores_expiration(self):
+        self.client.post(reverse("account_login"), {"username": "user1", "password": "changeme"})
+        data = self.client.session[PASSWORD_EXPIRY_SESSION_KEY]
+        self.assertEqual(data["user"], self.user.pk)
+        self.assertEqual(data["expiration"], (self.history.timestamp + datetime.timedelta(seconds=60)).timestamp())
+
+
+@override_settings(ACCOUNT_PASSWORD_USE_HISTORY=True, ACCOUNT_PASSWORD_EXPIRY=3600)
+class AnnotatePasswordExpirationTestCase(TestCase):
+
+    def setUp(self):
+        self.now = datetime.datetime.now(tz=pytz.UTC).replace(microsecond=0)
+        self.default = User.objects.create_user("default")
+        self.custom = User.objects.create_user("custom")
+        self.never = User.objects.create_user("never")
+        self.no_history = User.objects.create_user("no_history")
+        PasswordExpiry.objects.create(user=self.custom, expiry=60)
+        PasswordExpiry.objects.create(user=self.never, expiry=0)
+        for user in [self.default, self.custom, self.never]:
+            PasswordHistory.objects.create(user=user, timestamp=self.now - datetime.timedelta(days=1))
+            PasswordHistory.objects.create(user=user, timestamp=self.now)
+
+    def test_annotation(self):
+        with self.assertNumQueries(1):
+            users = {
+                user.username: user
+                for user in annotate_password_expiration(User.objects.all())
+            }
+        self.assertEqual(users["default"].password_changed, self.now)
+        self.assertEqual(users["default"].password_expiration, self.now + datetime.timedelta(seconds=3600))
+        self.assertEqual(users["custom"].password_expiration, self.now + datetime.timedelta(seconds=60))
+        self.assertIsNone(users["never"].password_expiration)
+        self.assertIsNone(users["no_history"].password_expiration)
+        for user in [self.default, self.custom]:
+            self.assertEqual(users[user.username].password_expiration, get_password_expiration(user))
+
+    def test_filter(self):
+        users = annotate_password_expiration(User.objects.all()).filter(
+            password_expiration__lt=self.now + datetime.timedelta(minutes=30),
+        )
+        self.assertEqual(list(users), [self.custom])
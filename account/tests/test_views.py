@@ -1,3 +1,5 @@
+import datetime
+from unittest import mock
 from urllib.parse import urlparse
 
 from django.conf import settings
@@ -5,9 +7,11 @@ from django.contrib.auth.models import User
 from django.core import mail
 from django.test import TestCase, override_settings
 from django.urls import reverse
+from django.utils import timezone
 from django.utils.http import int_to_base36
 
-from account.models import EmailConfirmation, SignupCode
+from account import signals
+from account.models import EmailAddress, EmailConfirmation, SignupCode
 from account.views import INTERNAL_RESET_URL_TOKEN, PasswordResetTokenView
 
 
@@ -68,6 +72,28 @@ class SignupViewTestCase(TestCase):
             self.assertEqual(response.status_code, 200)
             self.assertEqual(response.template_name, "account/signup_closed.html")
 
+    def test_exhausted_code(self):
+        signup_code = SignupCode.create(max_uses=1)
+        signup_code.save()
+        # another request redeems the code after it was checked
+        SignupCode.objects.filter(pk=signup_code.pk).update(use_count=1)
+        data = {
+            "username": "foo",
+            "password": "bar",
+            "password_confirm": "bar",
+            "email": "foobar@example.com",
+            "code": signup_code.code,
+        }
+        with mock.patch.object(SignupCode, "check_code", return_value=signup_code):
+            response = self.client.post(reverse("account_signup"), data)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            response.context_data["form"].non_field_errors(),
+            ["The code {} is invalid.".format(signup_code.code)],
+        )
+        self.assertFalse(User.objects.filter(username="foo").exists())
+        self.assertFalse(signup_code.signupcoderesult_set.exists())
+
     def test_get_authenticated(self):
         User.objects.create_user("foo", password="bar")
         self.client.login(username="foo", password="bar")
@@ -347,7 +373,8 @@ class ChangePasswordViewTestCase(TestCase):
             "password_new": "new-bar",
             "password_new_confirm": "new-bar",
         }
-        response = self.client.post(reverse("account_password"), data)
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(reverse("account_password"), data)
         self.assertRedirects(
             response,
             reverse(settings.ACCOUNT_PASSWORD_CHANGE_REDIRECT_URL),
@@ -365,7 +392,8 @@ class ChangePasswordViewTestCase(TestCase):
             "password_new": "new-bar",
             "password_new_confirm": "new-bar",
         }
-        response = self.client.post(reverse("account_password"), data)
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(reverse("account_password"), data)
         self.assertRedirects(
             response,
             reverse(settings.ACCOUNT_PASSWORD_CHANGE_REDIRECT_URL),
@@ -393,7 +421,8 @@ class PasswordResetTokenViewTestCase(TestCase):
         data = {
             "email": user.email,
         }
-        self.client.post(reverse("account_password_reset"), data)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse("account_password_reset"), data)
         parsed = urlparse(mail.outbox[0].body.strip())
         return user, parsed.path
 
@@ -451,3 +480,60 @@ class PasswordResetTokenViewTestCase(TestCase):
             reverse(settings.ACCOUNT_PASSWORD_RESET_REDIRECT_URL),
             fetch_redirect_response=False
         )
+
+
+@override_settings(ACCOUNT_EMAIL_CONFIRMATION_SIGNED=True)
+class SignedConfirmEmailViewTestCase(TestCase):
+
+    def signup(self):
+        data = {
+            "username": "foo",
+            "password": "bar",
+            "password_confirm": "bar",
+            "email": "foobar@example.com",
+        }
+        sent = []
+
+        def receiver(sender, confirmation, **kwargs):
+            sent.append(confirmation)
+
+        signals.email_confirmation_sent.connect(receiver)
+        try:
+            self.client.post(reverse("account_signup"), data)
+        finally:
+            signals.email_confirmation_sent.disconnect(receiver)
+        self.client.logout()
+        return sent[0].key
+
+    def test_no_confirmation_stored(self):
+        self.signup()
+        self.assertFalse(EmailConfirmation.objects.exists())
+
+    def test_get_good_key(self):
+        key = self.signup()
+        response = self.client.get(reverse("account_confirm_email", kwargs={"key": key}))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context["confirmation"].email_address.email, "foobar@example.com")
+
+    def test_get_tampered_key(self):
+        key = self.signup()
+        response = self.client.get(reverse("account_confirm_email", kwargs={"key": key[:-1] + "x"}))
+        self.assertEqual(response.status_code, 404)
+
+    def test_post(self):
+        key = self.signup()
+        self.client.post(reverse("account_confirm_email", kwargs={"key": key}), {})
+        self.assertTrue(EmailAddress.objects.get(email="foobar@example.com").verified)
+
+    def test_post_expired(self):
+        key = self.signup()
+        later = timezone.now() + datetime.timedelta(days=settings.ACCOUNT_EMAIL_CONFIRMATION_EXPIRE_DAYS, seconds=1)
+        with mock.patch("account.models.timezone.now", return_value=later):
+            self.client.post(reverse("account_confirm_email", kwargs={"key": key}), {})
+        self.assertFalse(EmailAddress.objects.get(email="foobar@example.com").verified)
+
+    def test_changed_email(self):
+        key = self.signup()
+        EmailAddress.objects.filter(email="foobar@example.com").update(email="other@example.com")
+        response = self.client.get(reverse("account_confirm_email", kwargs={"key": key}))
+        self.assertEqual(response.status_code, 404)
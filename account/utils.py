@@ -1,14 +1,22 @@
+import contextlib
+import csv
 import datetime
 import functools
+import json
+import sys
+import time
 from urllib.parse import urlparse, urlunparse
 
 from django.contrib.auth import get_user_model
 from django.core.exceptions import SuspiciousOperation
+from django.db.models import DateTimeField, DurationField, ExpressionWrapper, F, Func, Max, Value
+from django.db.models.functions import Coalesce, Lower, NullIf
 from django.http import HttpResponseRedirect, QueryDict
 from django.urls import NoReverseMatch, reverse
 from django.utils import timezone
 from django.utils.encoding import force_str
 
+from account.cache import password_expiry_version_key, peek_version
 from account.conf import settings
 
 from .models import PasswordHistory
@@ -22,6 +30,17 @@ def get_user_lookup_kwargs(kwargs):
     return result
 
 
+def iexact(queryset, field, value):
+    """
+    Filter queryset on a case-insensitive match of field against value.
+
+    Unlike ``__iexact`` this compiles to ``LOWER(field) = LOWER(value)`` which
+    can use the functional ``Lower()`` indexes shipped with the migrations.
+    """
+    alias = "{0}_lower".format(field)
+    return queryset.alias(**{alias: Lower(field)}).filter(**{alias: Lower(Value(value))})
+
+
 def default_redirect(request, fallback_url, **kwargs):
     redirect_field_name = kwargs.get("redirect_field_name", "next")
     next_url = request.POST.get(redirect_field_name, request.GET.get(redirect_field_name))
@@ -114,13 +133,16 @@ def is_ajax(request):
     return request.META.get('HTTP_X_REQUESTED_WITH') == 'XMLHttpRequest'
 
 
-def check_password_expired(user):
+PASSWORD_EXPIRY_SESSION_KEY = "_password_expiry"
+
+
+def get_password_expiration(user):
     """
-    Return True if password is expired and system is using
-    password expiration, False otherwise.
+    Return the datetime at which the user's password expires, or None if
+    the password never expires.
     """
     if not settings.ACCOUNT_PASSWORD_USE_HISTORY:
-        return False
+        return None
 
     if hasattr(user, "password_expiry"):
         # user-specific value
@@ -130,15 +152,156 @@ def check_password_expired(user):
         expiry = settings.ACCOUNT_PASSWORD_EXPIRY
 
     if expiry == 0:  # zero indicates no expiration
-        return False
+        return None
 
-    try:
-        # get latest password info
-        latest = user.password_history.latest("timestamp")
-    except PasswordHistory.DoesNotExist:
+    if hasattr(user, "latest_password_timestamp"):
+        # preloaded by AccountModelBackend
+        timestamp = user.latest_password_timestamp
+    else:
+        try:
+            # get latest password info
+            timestamp = user.password_history.latest("timestamp").timestamp
+        except PasswordHistory.DoesNotExist:
+            timestamp = None
+
+    if timestamp is None:
+        return None
+
+    return timestamp + datetime.timedelta(seconds=expiry)
+
+
+class Seconds(Func):
+    """
+    Converts an integer number of seconds to a duration.
+    """
+    output_field = DurationField()
+
+    def as_sql(self, compiler, connection, **extra_context):
+        if connection.features.has_native_duration_field:
+            template = "(%(expressions)s * INTERVAL '1 second')"
+        else:
+            # durations are stored as microseconds
+            template = "(%(expressions)s * 1000000)"
+        return super().as_sql(compiler, connection, template=template, **extra_context)
+
+    def as_oracle(self, compiler, connection, **extra_context):
+        return super().as_sql(compiler, connection, template="NUMTODSINTERVAL(%(expressions)s, 'SECOND')", **extra_context)
+
+
+def annotate_password_expiration(users):
+    """
+    Annotates a user queryset with ``password_changed``, the time of the
+    latest password history entry, and ``password_expiration``, the time the
+    password expires. Both are computed in the same query; users without
+    history or whose password never expires get None.
+    """
+    # zero means the password never expires
+    expiry = NullIf(Coalesce(F("password_expiry__expiry"), Value(settings.ACCOUNT_PASSWORD_EXPIRY)), Value(0))
+    return users.annotate(
+        password_changed=Max("password_history__timestamp"),
+        password_expiry_seconds=expiry,
+    ).annotate(
+        password_expiration=ExpressionWrapper(
+            F("password_changed") + Seconds(F("password_expiry_seconds")),
+            output_field=DateTimeField(),
+        ),
+    )
+
+
+def check_password_expired(user):
+    """
+    Return True if password is expired and system is using
+    password expiration, False otherwise.
+    """
+    expiration = get_password_expiration(user)
+    if expiration is None:
         return False
 
     now = timezone.now()
-    expiration = latest.timestamp + datetime.timedelta(seconds=expiry)
 
     return bool(expiration < now)
+
+
+def store_password_expiration(request, user):
+    """
+    Compute the password expiration for user and keep it in the session.
+    """
+    # read the version first so a change made while computing is noticed
+    # on the next request. the counter is only created by an invalidation.
+    version = peek_version(password_expiry_version_key(user.pk))
+    expiration = get_password_expiration(user)
+    request.session[PASSWORD_EXPIRY_SESSION_KEY] = {
+        "user": user.pk,
+        "version": version,
+        # the global expiry is kept so a policy change reaches every session
+        "expiry": settings.ACCOUNT_PASSWORD_EXPIRY,
+        "computed_at": time.time(),
+        "expiration": expiration.timestamp() if expiration is not None else None,
+    }
+    return expiration
+
+
+def session_password_expiration_stale(data, user):
+    """
+    Returns whether the password expiration kept in the session has to be
+    recomputed for user.
+    """
+    if data is None or data["user"] != user.pk:
+        return True
+    if data.get("expiry") != settings.ACCOUNT_PASSWORD_EXPIRY:
+        return True
+    version = peek_version(password_expiry_version_key(user.pk))
+    if version is not None:
+        return data["version"] != version
+    # the counter was evicted or lives in another process's cache, so the
+    # session value is only trusted for ACCOUNT_USER_CACHE_TIMEOUT seconds
+    timeout = settings.ACCOUNT_USER_CACHE_TIMEOUT
+    return timeout is not None and data.get("computed_at", 0) < time.time() - timeout
+
+
+def check_session_password_expired(request):
+    """
+    Like check_password_expired but uses the password expiration kept in
+    the session, only recomputing it when PasswordHistory or PasswordExpiry
+    changed for the user, when ACCOUNT_PASSWORD_EXPIRY changed or, without
+    a version counter, after ACCOUNT_USER_CACHE_TIMEOUT seconds.
+    """
+    if not settings.ACCOUNT_PASSWORD_USE_HISTORY:
+        return False
+    user = request.user
+    if not hasattr(request, "session"):
+        return check_password_expired(user)
+    data = request.session.get(PASSWORD_EXPIRY_SESSION_KEY)
+    if session_password_expiration_stale(data, user):
+        expiration = store_password_expiration(request, user)
+        return expiration is not None and expiration < timezone.now()
+    return data["expiration"] is not None and data["expiration"] < time.time()
+
+
+def read_records(stream, format="csv"):
+    """
+    Yields one dict per row of a CSV file with a header row, or per line of
+    a JSON lines file, reading the stream lazily.
+    """
+    if format == "jsonl":
+        for line in stream:
+            if line.strip():
+                yield json.loads(line)
+    else:
+        yield from csv.DictReader(stream)
+
+
+@contextlib.contextmanager
+def open_records(path, format=None):
+    """
+    Opens path, or stdin when path is ``-``, and yields its records as
+    returned by read_records. The format is guessed from the file extension
+    unless given.
+    """
+    if format is None:
+        format = "jsonl" if path.endswith((".jsonl", ".ndjson")) else "csv"
+    if path == "-":
+        yield read_records(sys.stdin, format)
+    else:
+        with open(path, newline="", encoding="utf-8") as stream:
+            yield read_records(stream, format)
@@ -4,6 +4,7 @@ from django.contrib.auth.hashers import make_password
 from django.contrib.auth.tokens import default_token_generator
 from django.contrib.sites.shortcuts import get_current_site
 from django.core.exceptions import ImproperlyConfigured
+from django.db import transaction
 from django.http import Http404, HttpResponseForbidden
 from django.shortcuts import get_object_or_404, redirect
 from django.urls import reverse
@@ -34,9 +35,16 @@ from account.models import (
     EmailAddress,
     EmailConfirmation,
     PasswordHistory,
+    SignedEmailConfirmation,
     SignupCode,
 )
-from account.utils import default_redirect, get_form_data, is_ajax
+from account.utils import (
+    default_redirect,
+    get_form_data,
+    iexact,
+    is_ajax,
+    store_password_expiration,
+)
 
 
 class PasswordMixin:
@@ -117,10 +125,17 @@ class PasswordMixin:
     def create_password_history(self, form, user):
         if settings.ACCOUNT_PASSWORD_USE_HISTORY:
             password = form.cleaned_data[self.form_password_field]
-            PasswordHistory.objects.create(
+            history = PasswordHistory.objects.create(
                 user=user,
                 password=make_password(password)
             )
+            if hasattr(user, "latest_password_timestamp"):
+                # preloaded by AccountModelBackend and now out of date
+                user.latest_password_timestamp = history.timestamp
+
+    def update_password_expiration(self, user):
+        if settings.ACCOUNT_PASSWORD_USE_HISTORY and self.request.user.pk == user.pk:
+            store_password_expiration(self.request, user)
 
 
 class SignupView(PasswordMixin, FormView):
@@ -223,8 +238,14 @@ class SignupView(PasswordMixin, FormView):
         # prevent User post_save signal from creating an Account instance
         # we want to handle that ourself.
         self.created_user._disable_account_creation = True
-        self.created_user.save()
-        self.use_signup_code(self.created_user)
+        try:
+            # the user only exists if the code could be redeemed
+            with transaction.atomic():
+                self.created_user.save()
+                self.use_signup_code(self.created_user)
+        except SignupCode.InvalidCode:
+            self.created_user = None
+            return self.signup_code_invalid(form)
         email_address = self.create_email_address(form)
         if settings.ACCOUNT_EMAIL_CONFIRMATION_REQUIRED and not email_address.verified:
             self.created_user.is_active = False
@@ -300,6 +321,13 @@ class SignupView(PasswordMixin, FormView):
         if self.signup_code:
             self.signup_code.use(user)
 
+    def signup_code_invalid(self, form):
+        message = self.messages.get("invalid_signup_code") or SignupView.messages["invalid_signup_code"]
+        form.add_error(None, message["text"].format(**{
+            "code": self.get_code(),
+        }))
+        return self.form_invalid(form)
+
     def send_email_confirmation(self, email_address):
         email_address.send_confirmation(site=get_current_site(self.request))
 
@@ -448,6 +476,8 @@ class LoginView(FormView):
         auth.login(self.request, form.user)
         expiry = settings.ACCOUNT_REMEMBER_ME_EXPIRY if form.cleaned_data.get("remember") else 0
         self.request.session.set_expiry(expiry)
+        if settings.ACCOUNT_PASSWORD_USE_HISTORY:
+            store_password_expiration(self.request, form.user)
 
 
 class LogoutView(TemplateResponseMixin, View):
@@ -549,6 +579,10 @@ class ConfirmEmailView(TemplateResponseMixin, View):
         return redirect(redirect_url)
 
     def get_object(self, queryset=None):
+        if settings.ACCOUNT_EMAIL_CONFIRMATION_SIGNED:
+            confirmation = SignedEmailConfirmation.from_key(self.kwargs["key"])
+            if confirmation is not None:
+                return confirmation
         if queryset is None:
             queryset = self.get_queryset()
         try:
@@ -613,6 +647,7 @@ class ChangePasswordView(PasswordMixin, FormView):
     def form_valid(self, form):
         self.change_password(form)
         self.create_password_history(form, self.request.user)
+        self.update_password_expiration(self.request.user)
         self.after_change_password()
         return redirect(self.get_success_url())
 
@@ -666,7 +701,7 @@ class PasswordResetView(FormView):
         User = get_user_model()
         protocol = settings.ACCOUNT_DEFAULT_HTTP_PROTOCOL
         current_site = get_current_site(self.request)
-        email_qs = EmailAddress.objects.filter(email__iexact=email)
+        email_qs = iexact(EmailAddress.objects.all(), "email", email)
         for user in User.objects.filter(pk__in=email_qs.values("user")):
             uid = int_to_base36(user.id)
             token = self.make_token(user)
@@ -734,6 +769,7 @@ class PasswordResetTokenView(PasswordMixin, FormView):
     def form_valid(self, form):
         self.change_password(form)
         self.create_password_history(form, self.get_user())
+        self.update_password_expiration(self.get_user())
         self.after_change_password()
         return redirect(self.get_success_url())
 
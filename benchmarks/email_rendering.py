@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+"""
+Measures account emails rendered per second with render_to_string and with
+account.mail.renderer.
+
+    python benchmarks/email_rendering.py [count]
+"""
+import os
+import sys
+import time
+
+import django
+
+
+def measure(label, count, render):
+    start = time.perf_counter()
+    render()
+    elapsed = time.perf_counter() - start
+    print("{0:<28} {1:>10.0f} emails/s".format(label, count / elapsed))
+
+
+def main(count=10000):
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "account.tests.settings")
+    django.setup()
+
+    from django.template.loader import render_to_string
+
+    from account.mail import EMAIL_TEMPLATES, renderer
+
+    subject_template, message_template = EMAIL_TEMPLATES["invite_user"]
+    emails = [
+        (["user{0}@example.com".format(i)], {"signup_url": "https://example.com/{0}".format(i)}, ["en", "nl"][i % 2])
+        for i in range(count)
+    ]
+
+    def render_each():
+        from django.utils import translation
+
+        for to, ctx, language in emails:
+            with translation.override(language):
+                render_to_string(subject_template, ctx)
+                render_to_string(message_template, ctx)
+
+    def render_cached():
+        for to, ctx, language in emails:
+            renderer.render("invite_user", ctx)
+
+    def render_many():
+        for email in renderer.render_many("invite_user", emails):
+            pass
+
+    measure("render_to_string", count, render_each)
+    measure("renderer.render", count, render_cached)
+    measure("renderer.render_many", count, render_many)
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])